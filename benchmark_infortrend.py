@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+'''
+End to end benchmark of check_infortrend against simulated arrays of
+increasing size.
+
+Every run checks a synthetic array served by infortrend_simulator in a
+fresh child process and reports the wall time, the SNMP round trips (the
+requests made by the native engine plus the net-snmp processes spawned
+by the subprocess backend) and the peak RSS of that child. The results
+can be saved as a baseline and later runs compared against it, so that
+a change which makes check_drive_status or check_device_status scale
+worse is caught before it is deployed.
+
+
+License:
+    check_infortrend, performs SNMP queries against Infortrend based RAIDS
+    Copyright (C) 2012  Erinn Looney-Triggs
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+from check_infortrend import CheckError, CheckInfortrend, Snmp
+from infortrend_simulator import InfortrendSimulator, synthetic_tree
+
+# Number of drives of each simulated array
+SIZES = (12, 48, 192, 1000)
+
+# Transports to benchmark
+BACKENDS = ('native', 'subprocess')
+
+# Drives per logical drive of the simulated arrays
+DRIVES_PER_LOGICAL_DRIVE = 12
+
+
+def simulated_tree(drives):
+    '''
+    Returns the OID tree of an array with the given number of drives, a
+    logical drive per twelve drives and a luDev row per drive, a drive
+    enclosure carries about as many sensors as it has slots.
+
+    >>> tree = simulated_tree(48)
+    >>> len([oid for oid in tree if '.1.9.1.6.' in oid])
+    48
+    '''
+    return synthetic_tree(drives=drives,
+                          logical_drives=max(1, drives //
+                                             DRIVES_PER_LOGICAL_DRIVE),
+                          devices=drives)
+
+
+def _run_check(agent, backend, results):
+    '''
+    For internal use, runs one check in a child process and puts its
+    measurements on the results queue.
+    '''
+    try:
+        check = CheckInfortrend(None, 'public', agent, 0, '2c', backend, 1)
+
+        startTime = time.time()
+        check.run_checks()
+        wallTime = time.time() - startTime
+
+        summary = check.trace_summary()
+        requests = sum([totals['requests'] for totals in summary.values()])
+        spawns = sum([totals['spawns'] for totals in summary.values()])
+
+        # ru_maxrss is in kilobytes on Linux, the net-snmp tools are
+        # children of their own
+        peakRss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+        results.put({'wall_time':wallTime,
+                     'round_trips':requests + spawns,
+                     'requests':requests,
+                     'spawns':spawns,
+                     'peak_rss_kb':peakRss,
+                     'exit_code':check.parse_results()[0],
+                     })
+    except CheckError, error:
+        results.put({'error':str(error)})
+
+    return None
+
+
+def measure(drives, backend, repeat=3):
+    '''
+    Check a simulated array of the given number of drives repeat times
+    with the given backend, each time in a new process. Returns the
+    fastest run.
+    '''
+    simulator = InfortrendSimulator(simulated_tree(drives))
+    simulator.start()
+    agent = '127.0.0.1:%d' % (simulator.port)
+
+    best = None
+
+    try:
+        for run in range(repeat):
+            results = multiprocessing.Queue()
+            child = multiprocessing.Process(target=_run_check,
+                                            args=(agent, backend, results))
+            child.start()
+            result = results.get()
+            child.join()
+
+            if 'error' in result:
+                raise CheckError(result['error'])
+
+            if best is None or result['wall_time'] < best['wall_time']:
+                best = result
+    finally:
+        simulator.stop()
+
+    return best
+
+
+def run_benchmark(sizes=SIZES, backends=BACKENDS, repeat=3, verbose=0):
+    '''
+    Measure every size with every backend, returns a dictionary of
+    backend to a dictionary of size, as a string, to measurements.
+    Backends whose tools are not installed are skipped.
+    '''
+    results = {}
+
+    for backend in backends:
+        if backend == 'subprocess' and not Snmp()._which('snmpget'):
+            print 'Skipping subprocess backend, snmpget is not installed'
+            continue
+
+        for drives in sizes:
+            result = measure(drives, backend, repeat)
+            results.setdefault(backend, {})[str(drives)] = result
+
+            if verbose > 0:
+                print 'Debug1: %s %d drives: %s' % (backend, drives, result)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    '''
+    Compare results against a baseline, returns a list of regressions.
+    Wall time and peak RSS may grow by tolerance, a fraction, round trips
+    may not grow at all.
+
+    >>> baseline = {'native':{'12':{'wall_time':0.1, 'round_trips':8,
+    ...                             'peak_rss_kb':9000}}}
+    >>> compare(baseline, baseline)
+    []
+    >>> results = {'native':{'12':{'wall_time':0.2, 'round_trips':9,
+    ...                            'peak_rss_kb':9000}}}
+    >>> for line in compare(results, baseline): print line
+    native 12 drives: round_trips 8 -> 9
+    native 12 drives: wall_time 0.100 -> 0.200
+    '''
+    regressions = []
+
+    for backend in sorted(results):
+        for size in sorted(results[backend], key=int):
+            old = baseline.get(backend, {}).get(size)
+            if old is None:
+                continue
+
+            new = results[backend][size]
+            limits = {'round_trips':old['round_trips'],
+                      'wall_time':old['wall_time'] * (1 + tolerance),
+                      'peak_rss_kb':old['peak_rss_kb'] * (1 + tolerance),
+                      }
+
+            for counter in sorted(limits):
+                if new[counter] > limits[counter]:
+                    if isinstance(new[counter], float):
+                        change = '%.3f -> %.3f' % (old[counter], new[counter])
+                    else:
+                        change = '%s -> %s' % (old[counter], new[counter])
+
+                    regressions.append('%s %s drives: %s %s'
+                                       % (backend, size, counter, change))
+
+    return regressions
+
+
+def print_results(results):
+    '''
+    Print the results as a table.
+    '''
+    print '%-10s %6s %10s %11s %7s %12s' % ('backend', 'drives', 'wall (s)',
+                                           'round trips', 'spawns',
+                                           'peak RSS kB')
+
+    for backend in sorted(results):
+        for size in sorted(results[backend], key=int):
+            result = results[backend][size]
+            print '%-10s %6s %10.3f %11d %7d %12d' % (backend, size,
+                                                     result['wall_time'],
+                                                     result['round_trips'],
+                                                     result['spawns'],
+                                                     result['peak_rss_kb'])
+
+    return None
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(description='''Benchmark
+    check_infortrend against simulated arrays of increasing size.''',
+    prog='benchmark_infortrend')
+    parser.add_option('--backend', action='append', type='choice',
+                      dest='backends', choices=list(BACKENDS), default=None,
+                      help=('Backend to benchmark, may be repeated '
+                      '(Default: all)'))
+    parser.add_option('--compare', action='store', type='string',
+                      dest='compare', default=None,
+                      help=('Baseline JSON file to compare against, exits '
+                      'non zero on a regression'))
+    parser.add_option('-r', '--repeat', dest='repeat', default=3,
+                      type='int', help=('Runs per measurement, the fastest '
+                      'is kept (Default: %default)'))
+    parser.add_option('--save', action='store', type='string', dest='save',
+                      default=None, help='Save the results as a baseline')
+    parser.add_option('--size', action='append', type='int', dest='sizes',
+                      default=None, help=('Number of drives to simulate, '
+                      'may be repeated (Default: %s)'
+                      % (', '.join([str(size) for size in SIZES]))))
+    parser.add_option('--tolerance', dest='tolerance', default=0.25,
+                      type='float', help=('Allowed growth of wall time and '
+                      'peak RSS over the baseline (Default: %default)'))
+    parser.add_option('-v', '--verbose', action='count', dest='verbose',
+                      default=0, help='Give verbose output')
+
+    (options, args) = parser.parse_args()
+
+    RESULTS = run_benchmark(options.sizes or SIZES,
+                            options.backends or BACKENDS, options.repeat,
+                            options.verbose)
+
+    print_results(RESULTS)
+
+    if options.save:
+        BASELINE_FILE = open(options.save, 'w')
+        try:
+            json.dump(RESULTS, BASELINE_FILE, indent=1, sort_keys=True)
+        finally:
+            BASELINE_FILE.close()
+
+    if options.compare:
+        REGRESSIONS = compare(RESULTS, json.load(open(options.compare)),
+                              options.tolerance)
+
+        for REGRESSION in REGRESSIONS:
+            print 'Regression:', REGRESSION
+
+        if REGRESSIONS:
+            sys.exit(1)
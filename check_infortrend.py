@@ -35,9 +35,27 @@ License:
 #TODO:
 # doctests
 
+import BaseHTTPServer
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
+import Queue
+import random
+import resource
+import select
+import socket
+import SocketServer
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urlparse
+import zlib
 
 __author__ = 'Erinn Looney-Triggs'
 __credits__ = ['Erinn Looney-Triggs', ]
@@ -53,6 +71,12 @@ CRITICAL = 2
 WARNING  = 1
 OK       = 0
 
+# State counters in the order they decide the exit code, with its code
+severityCodes = (('critical', CRITICAL),
+                 ('warning', WARNING),
+                 ('unknown', UNKNOWN),
+                 )
+
 blacklistoptions = {1:'power_supply',
                     2:'fan',
                     3:'temp_sensor',
@@ -73,64 +97,2146 @@ blacklistoptions = {1:'power_supply',
                     99:'absent_drives'
                     }
 
-class Snmp(object):
-    '''
-    A Basic Class for an SNMP session
-    '''
-    def __init__(self, version='2c', agent='localhost',
-                 community='public', verbose=0):
+# The luDev status of each device type is a bit field, each entry is
+# (lowest bit, width in bits, {field value: (message, severity)}) and the
+# severity is the self.state counter raised, None only reports. A
+# '%(description)s' in a message is replaced with the device description.
+luDevStatusRules = {1:[(0, 1, {1:('Power supply is malfunctioning',
+                                  'critical')}),
+                       (6, 1, {1:('Power supply is off', 'warning')}),
+                       (7, 1, {1:('Power supply is not present',
+                                  'critical')}),
+                       ],
+                    2:[(0, 1, {1:('Fan is malfunctioning', 'critical')}),
+                       (6, 1, {1:('Fan is off', 'warning')}),
+                       (7, 1, {1:('Fan is not present', 'critical')}),
+                       ],
+                    3:[(0, 1, {1:('Temperature sensor is malfunctioning',
+                                  'critical')}),
+                       (1, 3, {2:('Cold temperature warning', 'warning'),
+                               3:('Hot temperature warning', 'warning'),
+                               4:('Cold temperature limit exceeded',
+                                  'critical'),
+                               5:('Hot temperature limit exceeded',
+                                  'critical')}),
+                       (6, 1, {1:('Temperature sensor is not activated',
+                                  'warning')}),
+                       (7, 1, {1:('Temperature sensor is not present',
+                                  'critical')}),
+                       ],
+                    4:[(0, 1, {1:('Unit is malfunctioning', 'critical')}),
+                       (1, 1, {1:('AC Power not present', 'critical')}),
+                       (2, 2, {1:('Battery not fully charged', 'warning'),
+                               2:('Battery charge critically low',
+                                  'critical'),
+                               3:('Battery completely drained',
+                                  'critical')}),
+                       (6, 1, {1:('UPS is off', 'warning')}),
+                       (7, 1, {1:('UPS is not present', 'critical')}),
+                       ],
+                    5:[(0, 1, {1:('Voltage sensor is malfunctioning',
+                                  'critical')}),
+                       (1, 3, {2:('Low voltage warning', 'warning'),
+                               3:('High voltage warning', 'warning'),
+                               4:('Low voltage limit exceeded', 'critical'),
+                               5:('High voltage limit exceeded',
+                                  'critical')}),
+                       (6, 1, {1:('Voltage sensor is not activated',
+                                  'warning')}),
+                       (7, 1, {1:('Voltage sensor is not present',
+                                  'critical')}),
+                       ],
+                    6:[(0, 1, {1:('Current sensor malfunctioning',
+                                  'critical')}),
+                       (1, 3, {3:('Over current warning', 'warning'),
+                               5:('Over current limit exceeded',
+                                  'critical')}),
+                       (6, 1, {1:('Current sensor is not activated',
+                                  'warning')}),
+                       (7, 1, {1:('Current sensor not present',
+                                  'critical')}),
+                       ],
+                    9:[(0, 1, {1:('Door, door lock, or door sensor '
+                                  'malfunctioning', 'critical')}),
+                       (1, 1, {1:('Door is open', 'warning')}),
+                       (6, 1, {1:('Door lock not engaged', 'warning')}),
+                       (7, 1, {1:('Door is not present', 'critical')}),
+                       ],
+                    10:[(0, 1, {1:('Speaker is malfunctioning',
+                                   'critical')}),
+                        (6, 1, {1:('Speaker is off', 'warning')}),
+                        (7, 1, {1:('Speaker is not present', 'critical')}),
+                        ],
+                    11:[(0, 1, {1:('Battery is malfunctioning',
+                                   'critical')}),
+                        (1, 1, {1:('Battery charging on', None)}),
+                        (2, 2, {1:('Battery not fully charged', None),
+                                2:('Battery charge critically low',
+                                   'critical'),
+                                3:('Battery completely drained',
+                                   'critical')}),
+                        # This is a normal state on cheaper RAIDs thus no
+                        # warning
+                        (6, 1, {1:('Battery-backup is disabled', None)}),
+                        (7, 1, {1:('Battery is not present', 'critical')}),
+                        ],
+                    # Even if the led is active don't warn, it's too common
+                    12:[(6, 1, {1:('ON', None)}),
+                        ],
+                    13:[(0, 1, {1:('Flash Device malfunctioning',
+                                   'critical')}),
+                        ],
+                    14:[(0, 1, {1:('%(description)s malfunctioning',
+                                   'critical')}),
+                        ],
+                    17:[(0, 1, {1:('Slot sense circuitry is malfunctioning',
+                                   'critical')}),
+                        (1, 1, {1:('Device in slot has been marked bad and '
+                                   'is awaiting a replacement', 'warning')}),
+                        (2, 1, {1:('Slot is not activated', 'warning')}),
+                        (6, 1, {1:('Slot is ready for insertion/removal',
+                                   None)}),
+                        (7, 1, {1:('Slot is empty', 'warning')}),
+                        ],
+                    }
+luDevStatusRules[8] = luDevStatusRules[3]
+luDevStatusRules[18] = luDevStatusRules[14]
+luDevStatusRules[31] = luDevStatusRules[14]
+
+# Part of the signature of every cached row evaluation, rows evaluated by
+# another version of the plugin or with other status rules are decoded
+# again instead of reused
+evaluationVersion = '%s-%08x' % (__version__, zlib.crc32(repr(sorted(
+    luDevStatusRules.items()))) & 0xffffffff)
+
+# luDev types whose value and value unit are looked at: fans, temperature,
+# voltage and current sensors
+luDevValueTypes = (2, 3, 5, 6, 8)
+
+#Infortrend decided to do mappings from certain numbers to fan speeds
+#Why they couldn't just output the speed is beyond me, but I don't do
+#hardware design so maybe there is a good reason.
+fanSpeedsOld = {0:0,           #Indicates fan speed is not available.
+                12292:4000,
+                77828:4285,
+                143364:4570,
+                208900:4571,
+                274436:4857,
+                339972:5428,
+                405508:5713,
+                471044:5800,
+                }
+fanSpeedsNew = {1:4000,
+                2:4285,
+                3:4570,
+                0:4571,
+                4:4857,
+                5:5428,
+                6:5713,
+                7:5800,
+                }
+
+# Messages net-snmp prints for the SNMPv2 exception values, the in-process
+# engine hands back the same text so callers can't tell the backends apart.
+NO_SUCH_OBJECT = 'No Such Object available on this agent at this OID'
+NO_SUCH_INSTANCE = 'No Such Instance currently exists at this OID'
+END_OF_MIB_VIEW = ('No more variables left in this MIB View '
+                   '(It is past the end of the MIB tree)')
+
+# BER tags used by SNMPv1/v2c
+ASN1_INTEGER = 0x02
+ASN1_OCTET_STRING = 0x04
+ASN1_NULL = 0x05
+ASN1_OBJECT_IDENTIFIER = 0x06
+ASN1_SEQUENCE = 0x30
+SNMP_IPADDRESS = 0x40
+SNMP_COUNTER32 = 0x41
+SNMP_GAUGE32 = 0x42
+SNMP_TIMETICKS = 0x43
+SNMP_OPAQUE = 0x44
+SNMP_COUNTER64 = 0x46
+SNMP_NOSUCHOBJECT = 0x80
+SNMP_NOSUCHINSTANCE = 0x81
+SNMP_ENDOFMIBVIEW = 0x82
+PDU_GET = 0xa0
+PDU_GETNEXT = 0xa1
+PDU_RESPONSE = 0xa2
+PDU_GETBULK = 0xa5
+
+SNMP_EXCEPTIONS = {SNMP_NOSUCHOBJECT:NO_SUCH_OBJECT,
+                   SNMP_NOSUCHINSTANCE:NO_SUCH_INSTANCE,
+                   SNMP_ENDOFMIBVIEW:END_OF_MIB_VIEW,
+                   }
+
+# error-status for a response that would not fit in the agent's
+# largest message
+SNMP_ERROR_TOOBIG = 1
+
+# SNMPv1 error-status for a missing variable
+SNMP_ERROR_NOSUCHNAME = 2
+
+
+class CheckError(Exception):
+    '''
+    Raised when a check can not carry on. Carries the message to print
+    and the Nagios status to exit with.
+    '''
+    def __init__(self, message, status=CRITICAL):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class CheckTimeout(CheckError):
+    '''
+    Raised when the agent stops answering or the deadline passes, what
+    was collected until then is still worth reporting.
+    '''
+    def __init__(self, message, status=UNKNOWN):
+        CheckError.__init__(self, message, status)
+
+
+class SnmpError(Exception):
+    '''
+    Raised by the in-process SNMP engine when an agent does not answer or
+    answers with something we can not decode.
+    '''
+    pass
+
+
+class SnmpTimeout(SnmpError):
+    '''
+    Raised by the in-process SNMP engine when an agent does not answer
+    within its retries or the deadline.
+    '''
+    pass
+
+
+def _check_error(error):
+    '''
+    For internal use, returns the CheckError to raise for the SnmpError
+    error, a CheckTimeout if the agent did not answer.
+
+    >>> _check_error(SnmpTimeout('Timeout: No Response from localhost'))
+    CheckTimeout('Timeout: No Response from localhost',)
+    >>> _check_error(SnmpError('Truncated BER data')).status
+    2
+    '''
+    if isinstance(error, SnmpTimeout):
+        return CheckTimeout(str(error))
+
+    return CheckError(str(error))
+
+
+def _ber_length(length):
+    '''
+    For internal use, BER encodes a length field.
+
+    >>> _ber_length(5)
+    '\\x05'
+    >>> _ber_length(300)
+    '\\x82\\x01,'
+    '''
+    if length < 0x80:
+        return chr(length)
+
+    octets = ''
+    while length:
+        octets = chr(length & 0xff) + octets
+        length >>= 8
+
+    return chr(0x80 | len(octets)) + octets
+
+def _ber_tlv(tag, payload):
+    '''
+    For internal use, wraps payload in a tag and length.
+    '''
+    return chr(tag) + _ber_length(len(payload)) + payload
+
+def _ber_integer(value):
+    '''
+    For internal use, BER encodes a two's complement integer.
+
+    >>> _ber_integer(128)
+    '\\x02\\x02\\x00\\x80'
+    >>> _ber_integer(-1)
+    '\\x02\\x01\\xff'
+    '''
+    octets = ''
+    while True:
+        octets = chr(value & 0xff) + octets
+        if -0x80 <= value < 0x80:
+            break
+        value >>= 8
+
+    return _ber_tlv(ASN1_INTEGER, octets)
+
+def _ber_oid(oid):
+    '''
+    For internal use, BER encodes a dotted numerical OID. Leading and
+    trailing dots are ignored.
+
+    >>> _ber_oid('1.3.6.1.4.1.1714.')
+    '\\x06\\x07+\\x06\\x01\\x04\\x01\\x8d2'
+    '''
+    arcs = [int(arc) for arc in oid.strip('.').split('.')]
+    payload = ''
+
+    for arc in [arcs[0] * 40 + arcs[1]] + arcs[2:]:
+        chunk = chr(arc & 0x7f)
+        arc >>= 7
+        while arc:
+            chunk = chr(0x80 | (arc & 0x7f)) + chunk
+            arc >>= 7
+        payload += chunk
+
+    return _ber_tlv(ASN1_OBJECT_IDENTIFIER, payload)
+
+def _ber_read(data, offset):
+    '''
+    For internal use, reads one TLV from the bytearray data starting at
+    offset. Returns a tuple of the tag, the start and the end of the
+    value.
+    '''
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+
+        if length & 0x80:
+            count = length & 0x7f
+            length = 0
+            for octet in data[offset:offset + count]:
+                length = (length << 8) | octet
+            offset += count
+    except IndexError:
+        raise SnmpError('Truncated BER data')
+
+    if offset + length > len(data):
+        raise SnmpError('Truncated BER data')
+
+    return tag, offset, offset + length
+
+def _ber_decode_integer(data, signed=True):
+    '''
+    For internal use, decodes the value octets of an integer.
+    '''
+    value = 0
+    for octet in data:
+        value = (value << 8) | octet
+
+    if signed and data and data[0] & 0x80:
+        value -= 1 << (8 * len(data))
+
+    return value
+
+def _ber_decode_oid(data):
+    '''
+    For internal use, decodes the value octets of an OID into a dotted
+    string.
+    '''
+    arcs = []
+    arc = 0
+    for octet in data:
+        arc = (arc << 7) | (octet & 0x7f)
+        if not octet & 0x80:
+            arcs.append(arc)
+            arc = 0
+
+    if not arcs:
+        return ''
+
+    first = min(arcs[0] // 40, 2)
+    arcs[0:1] = [first, arcs[0] - first * 40]
+
+    return '.'.join([str(arc) for arc in arcs])
+
+def _ber_decode_value(tag, data):
+    '''
+    For internal use, turns a varbind value into a python value. Integers
+    of all flavours become integers, exceptions become the net-snmp
+    message and everything else becomes a string.
+    '''
+    if tag == ASN1_INTEGER:
+        return _ber_decode_integer(data)
+    elif tag in (SNMP_COUNTER32, SNMP_GAUGE32, SNMP_TIMETICKS,
+                 SNMP_COUNTER64):
+        return _ber_decode_integer(data, signed=False)
+    elif tag == ASN1_OBJECT_IDENTIFIER:
+        return _ber_decode_oid(data)
+    elif tag == SNMP_IPADDRESS:
+        return '.'.join([str(octet) for octet in data])
+    elif tag in SNMP_EXCEPTIONS:
+        return SNMP_EXCEPTIONS[tag]
+    elif tag == ASN1_NULL:
+        return ''
+
+    return str(data)
+
+def _oid_in_subtree(oid, root):
+    '''
+    For internal use, True if oid lives below root.
+
+    >>> _oid_in_subtree('1.3.6.1.4.1.1714.1.9.1.8.1', '1.3.6.1.4.1.1714.1.9.1.8')
+    True
+    >>> _oid_in_subtree('1.3.6.1.4.1.1714.1.9.1.80.1', '1.3.6.1.4.1.1714.1.9.1.8')
+    False
+    '''
+    return oid.startswith(root.strip('.') + '.')
+
+def _oid_tuple(oid):
+    '''
+    For internal use, turns a dotted OID into a tuple for ordering.
+    '''
+    return tuple([int(arc) for arc in oid.strip('.').split('.')])
+
+
+def _run_concurrently(functions, width):
+    '''
+    For internal use, calls every function in the list functions using up
+    to width threads and returns their results in the same order. The
+    first exception raised by any of them, SystemExit included, is raised
+    again in the calling thread.
+
+    >>> _run_concurrently([lambda: 1, lambda: 2, lambda: 3], 2)
+    [1, 2, 3]
+    '''
+    if width <= 1 or len(functions) <= 1:
+        return [function() for function in functions]
+
+    results = [None] * len(functions)
+    errors = []
+    tasks = Queue.Queue()
+
+    for task in enumerate(functions):
+        tasks.put(task)
+
+    def worker():
+        '''
+        Takes functions off the queue until it is empty or one failed.
+        '''
+        while not errors:
+            try:
+                position, function = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                results[position] = function()
+            except BaseException:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(width, len(functions)))]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Join with a timeout so signals still reach the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.05)
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+    return results
+
+
+class Deadline(object):
+    '''
+    The time a run has to be finished by, shared by every query of the
+    run so each one only waits for what is left of it. A deadline
+    without seconds never expires.
+
+    >>> deadline = Deadline(None)
+    >>> deadline.remaining(), deadline.expired()
+    (None, False)
+    >>> Deadline(0).expired()
+    True
+    '''
+
+    def __init__(self, seconds=None):
+
+        self.start(seconds)
+
+    def start(self, seconds):
+        '''
+        Start the clock again, seconds from now.
+        '''
+        self.seconds = seconds
+        self.expires = None
+
+        if seconds is not None:
+            self.expires = time.time() + seconds
+
+        return None
+
+    def remaining(self):
+        '''
+        Returns the seconds left, None if there is no deadline.
+        '''
+        if self.expires is None:
+            return None
+
+        return max(0.0, self.expires - time.time())
+
+    def expired(self):
+        '''
+        Returns True once the deadline has passed.
+        '''
+        return self.expires is not None and time.time() >= self.expires
+
+
+def _peek_request_id(message):
+    '''
+    For internal use, returns the request id of an SNMP message without
+    decoding the rest of it.
+
+    >>> engine = SnmpEngine('127.0.0.1')
+    >>> _peek_request_id(engine._encode(PDU_GET, 4242, ['1.3.6.1']))
+    4242
+    '''
+    data = bytearray(message)
+
+    tag, start, end = _ber_read(data, 0)
+    if tag != ASN1_SEQUENCE:
+        raise SnmpError('Not an SNMP message')
+
+    # Version, community and the PDU holding the request id
+    tag, start, offset = _ber_read(data, start)
+    tag, start, offset = _ber_read(data, offset)
+    tag, start, end = _ber_read(data, offset)
+    tag, start, offset = _ber_read(data, start)
+
+    return _ber_decode_integer(data[start:offset])
+
+
+class SnmpTransport(object):
+    '''
+    A small pool of UDP sockets shared by every SnmpEngine given it,
+    however many agents they talk to. One dispatcher thread reads all of
+    the sockets and hands each response to the request waiting for its
+    request id, so responses may come back in any order and a response
+    nobody waits for any more, or from the wrong address, is dropped.
+    The request ids SnmpEngine hands out are unique within the process.
+
+    size: an integer, sockets per address family
+
+    >>> from infortrend_simulator import InfortrendSimulator, synthetic_tree
+    >>> simulator = InfortrendSimulator(synthetic_tree())
+    >>> simulator.start()
+    >>> transport = SnmpTransport(2)
+    >>> engines = [SnmpEngine('127.0.0.1:%d' % simulator.port,
+    ...                       transport=transport) for i in range(8)]
+    >>> oid = '1.3.6.1.4.1.1714.1.1.1.1.10.0'
+    >>> _run_concurrently([lambda engine=engine: engine.get([oid])[0][1]
+    ...                    for engine in engines], 8)
+    [8001234, 8001234, 8001234, 8001234, 8001234, 8001234, 8001234, 8001234]
+    >>> len(transport.sockets[socket.AF_INET])
+    2
+    >>> transport.close()
+    >>> simulator.stop()
+    '''
+
+    def __init__(self, size=4):
+
+        self.size = size
+
+        # family: [socket], created on first use
+        self.sockets = {}
+
+        # request id: (address the response must come from, Queue)
+        self.waiters = {}
+        self.lock = threading.Lock()
+
+        # Written to when the dispatcher should look at the sockets again
+        self.wakeup = os.pipe()
+        self.closed = False
+
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def register(self, request_id, address):
+        '''
+        Start waiting for the response to request_id from address, returns
+        the Queue it is put on.
+        '''
+        replies = Queue.Queue()
+
+        with self.lock:
+            self.waiters[request_id] = (address, replies)
+
+        return replies
+
+    def unregister(self, request_id):
+        '''
+        Stop waiting for the response to request_id.
+        '''
+        with self.lock:
+            self.waiters.pop(request_id, None)
+
+        return None
+
+    def send(self, request_id, message, family, address):
+        '''
+        Send message, holding request_id, to address.
+        '''
+        with self.lock:
+            if family not in self.sockets:
+                self.sockets[family] = [socket.socket(family,
+                                                      socket.SOCK_DGRAM)
+                                        for i in range(self.size)]
+                os.write(self.wakeup[1], 'x')
+
+            sock = self.sockets[family][request_id % self.size]
+
+        sock.sendto(message, address)
+
+        return None
+
+    def _dispatch(self):
+        '''
+        For internal use, the dispatcher thread, routes every datagram
+        read to its waiter until close is called.
+        '''
+        while not self.closed:
+            with self.lock:
+                sockets = sum(self.sockets.values(), [])
+
+            try:
+                ready = select.select(sockets + [self.wakeup[0]], [], [])[0]
+            except (select.error, socket.error):
+                continue
+
+            for sock in ready:
+                if sock == self.wakeup[0]:
+                    os.read(self.wakeup[0], 512)
+                    continue
+
+                try:
+                    datagram, source = sock.recvfrom(65535)
+                    request_id = _peek_request_id(datagram)
+                except (socket.error, SnmpError, IndexError):
+                    continue
+
+                with self.lock:
+                    waiter = self.waiters.get(request_id)
+
+                if waiter and waiter[0][:2] == source[:2]:
+                    waiter[1].put(datagram)
+
+        return None
+
+    def close(self):
+        '''
+        Stop the dispatcher and close the sockets.
+        '''
+        self.closed = True
+        os.write(self.wakeup[1], 'x')
+        self.dispatcher.join()
+
+        for sock in sum(self.sockets.values(), []):
+            sock.close()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+        return None
+
+
+# SnmpTransport of each process, see shared_transport
+_sharedTransports = {}
+_sharedTransportLock = threading.Lock()
+
+def shared_transport(size=4):
+    '''
+    Returns the SnmpTransport every CheckInfortrend of this process
+    shares, creating it with size sockets on first use. A forked child
+    gets one of its own.
+    '''
+    with _sharedTransportLock:
+        if os.getpid() not in _sharedTransports:
+            _sharedTransports[os.getpid()] = SnmpTransport(size)
+
+        return _sharedTransports[os.getpid()]
+
+
+class SnmpEngine(object):
+    '''
+    A minimal in-process SNMPv1/v2c engine. Encodes and decodes BER
+    directly and talks to the agent over UDP, saving us the fork/exec of
+    the net-snmp tools on every query.
+
+    agent: a string, either a host or host:port
+    community: a string giving the community password
+    version: a string, only 1 and 2c are supported
+    timeout: a float, longest wait for any one attempt, shorter waits
+    are used once the latency of the agent is known
+    retries: an integer, number of retransmissions after the first attempt
+    deadline: a Deadline, no request waits past it
+    transport: an SnmpTransport to send through, instead of a socket of
+    its own for every request
+    '''
+
+    _request_ids = itertools.count(random.randint(1, 0x3fffffff))
+
+    # Most varbinds put in one GET, keeps responses within a datagram
+    max_varbinds = 32
+
+    # Varbinds asked for by each GETBULK, shared out among the columns
+    max_bulk_varbinds = 50
+
+    # Shortest wait for an attempt, however quick the agent has been
+    min_timeout = 0.05
+
+    def __init__(self, agent='localhost', community='public', version='2c',
+                 timeout=1.0, retries=5, deadline=None, transport=None):
+
+        self.agent = agent
+        self.community = community
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = deadline
+        self.transport = transport
+
+        # Smoothed round trip time and its variation, as TCP keeps them
+        self.srtt = None
+        self.rttvar = None
+        self.latency_lock = threading.Lock()
+
+        if version == '1':
+            self.version = 0
+        elif version == '2c':
+            self.version = 1
+        else:
+            raise SnmpError('Unsupported SNMP version: %s' % (version))
+
+        self.address = self._resolve(agent)
+
+    def _resolve(self, agent):
+        '''
+        For internal use, resolves the agent string to a socket address.
+        A port may be given as host:port, the default is 161.
+        '''
+        host, port = agent, 161
+
+        if agent.count(':') == 1:
+            host, port = agent.split(':')
+
+        try:
+            info = socket.getaddrinfo(host, int(port), 0, socket.SOCK_DGRAM)
+        except (socket.error, ValueError):
+            raise SnmpError('Unable to resolve agent: %s' % (agent))
+
+        return info[0][0], info[0][4]
+
+    def _encode(self, pdu_type, request_id, oids, field1=0, field2=0):
+        '''
+        For internal use, builds a complete SNMP message. field1 and field2
+        are the error status and index, or for GETBULK the non-repeaters
+        and max-repetitions.
+        '''
+        varbinds = ''.join([_ber_tlv(ASN1_SEQUENCE,
+                                     _ber_oid(oid) + _ber_tlv(ASN1_NULL, ''))
+                            for oid in oids])
+
+        pdu = _ber_tlv(pdu_type, _ber_integer(request_id) +
+                                 _ber_integer(field1) +
+                                 _ber_integer(field2) +
+                                 _ber_tlv(ASN1_SEQUENCE, varbinds))
+
+        return _ber_tlv(ASN1_SEQUENCE, _ber_integer(self.version) +
+                        _ber_tlv(ASN1_OCTET_STRING, self.community) + pdu)
+
+    def _decode(self, message):
+        '''
+        For internal use, decodes a response message. Returns a tuple of
+        the request id, the error status, the error index and a list of
+        (oid, value) tuples.
+        '''
+        data = bytearray(message)
+
+        tag, start, end = _ber_read(data, 0)
+        if tag != ASN1_SEQUENCE:
+            raise SnmpError('Response is not an SNMP message')
+
+        # Version and community
+        tag, start, offset = _ber_read(data, start)
+        tag, start, offset = _ber_read(data, offset)
+
+        tag, start, end = _ber_read(data, offset)
+        if tag != PDU_RESPONSE:
+            raise SnmpError('Unexpected PDU type: 0x%02x' % (tag))
+
+        fields = []
+        offset = start
+        for i in range(3):
+            tag, start, offset = _ber_read(data, offset)
+            fields.append(_ber_decode_integer(data[start:offset]))
+
+        tag, offset, end = _ber_read(data, offset)
+
+        varbinds = []
+        while offset < end:
+            tag, start, offset = _ber_read(data, offset)
+            tag, oid_start, oid_end = _ber_read(data, start)
+            tag, value_start, value_end = _ber_read(data, oid_end)
+            varbinds.append((_ber_decode_oid(data[oid_start:oid_end]),
+                             _ber_decode_value(tag,
+                                               data[value_start:value_end])))
+
+        return fields[0], fields[1], fields[2], varbinds
+
+    def attempt_timeout(self):
+        '''
+        Returns the seconds to wait for the first attempt of a request,
+        four deviations above the smoothed round trip time of the agent
+        once it is known, bounded by min_timeout and timeout.
+
+        >>> engine = SnmpEngine('127.0.0.1')
+        >>> engine.attempt_timeout()
+        1.0
+        >>> engine.set_latency(0.02, 0.005)
+        >>> engine.attempt_timeout()
+        0.05
+        '''
+        with self.latency_lock:
+            if self.srtt is None:
+                return self.timeout
+
+            return min(self.timeout, max(self.min_timeout,
+                                         self.srtt + 4 * self.rttvar))
+
+    def _observe(self, rtt):
+        '''
+        For internal use, folds one round trip time into the smoothed
+        estimate, with the gains of RFC 6298.
+        '''
+        with self.latency_lock:
+            if self.srtt is None:
+                self.srtt, self.rttvar = rtt, rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        return None
+
+    def get_latency(self):
+        '''
+        Returns the smoothed round trip time and its variation, both None
+        until a response has been timed.
+        '''
+        with self.latency_lock:
+            return self.srtt, self.rttvar
+
+    def set_latency(self, srtt, rttvar):
+        '''
+        Start from a latency estimate taken earlier, get_latency's.
+        '''
+        with self.latency_lock:
+            self.srtt, self.rttvar = srtt, rttvar
+
+        return None
+
+    def request(self, pdu_type, oids, field1=0, field2=0, stats=None):
+        '''
+        Send one PDU to the agent and wait for the matching response,
+        retransmitting on timeout. Returns a tuple of the error status,
+        the error index and a list of (oid, value) tuples.
+
+        Each attempt waits twice as long as the one before, starting from
+        attempt_timeout, and none waits past the deadline.
+
+        If a stats dictionary is passed its requests, retries and bytes
+        counters are increased.
+        '''
+        if stats is None:
+            stats = {'requests':0, 'retries':0, 'bytes':0}
+
+        request_id = self._request_ids.next() & 0x7fffffff
+        message = self._encode(pdu_type, request_id, oids, field1, field2)
+        timeout = self.attempt_timeout()
+
+        if self.transport:
+            replies = self.transport.register(request_id, self.address[1])
+
+            def send():
+                self.transport.send(request_id, message, *self.address)
+
+            def receive(wait):
+                try:
+                    return replies.get(timeout=wait)
+                except Queue.Empty:
+                    return None
+
+            close = lambda: self.transport.unregister(request_id)
+        else:
+            sock = socket.socket(self.address[0], socket.SOCK_DGRAM)
+
+            def send():
+                sock.sendto(message, self.address[1])
+
+            def receive(wait):
+                if select.select([sock], [], [], wait)[0]:
+                    return sock.recv(65535)
+                return None
+
+            close = sock.close
+
+        try:
+            for attempt in range(self.retries + 1):
+                if self.deadline and self.deadline.expired():
+                    raise SnmpTimeout('Timeout: Deadline of %ss reached '
+                                      'waiting for %s'
+                                      % (self.deadline.seconds, self.agent))
+
+                send()
+                sentTime = time.time()
+                waitUntil = sentTime + timeout
+
+                if self.deadline and self.deadline.expires is not None:
+                    waitUntil = min(waitUntil, self.deadline.expires)
+
+                if attempt:
+                    stats['retries'] += 1
+                else:
+                    stats['requests'] += 1
+
+                while True:
+                    datagram = receive(max(0, waitUntil - time.time()))
+                    if datagram is None:
+                        break
+
+                    stats['bytes'] += len(datagram)
+
+                    try:
+                        response = self._decode(datagram)
+                    except SnmpError:
+                        # Garbage on the wire, keep waiting for ours
+                        continue
+
+                    # Stale answers to earlier requests are ignored
+                    if response[0] == request_id:
+                        # Only an unambiguous round trip is a sample
+                        if not attempt:
+                            self._observe(time.time() - sentTime)
+
+                        return response[1:]
+
+                timeout = min(timeout * 2, self.timeout)
+        finally:
+            close()
+
+        raise SnmpTimeout('Timeout: No Response from %s' % (self.agent))
+
+    def get(self, oids, stats=None):
+        '''
+        Perform a GET for the list of oids in one PDU, or one for every
+        max_varbinds of them, returns a list of (oid, value) tuples in the
+        same order. A missing variable on an
+        SNMPv1 agent is reported as No Such Object, just as SNMPv2c agents
+        do, and the request is sent again without it. A request whose
+        response would be too big for the agent is split in two.
+        '''
+        if len(oids) > self.max_varbinds:
+            return (self.get(oids[:self.max_varbinds], stats) +
+                    self.get(oids[self.max_varbinds:], stats))
+
+        results = dict([(position, (oid, NO_SUCH_OBJECT))
+                        for position, oid in enumerate(oids)])
+        pending = range(len(oids))
+
+        while pending:
+            error_status, error_index, varbinds = self.request(
+                PDU_GET, [oids[position] for position in pending],
+                stats=stats)
+
+            if (error_status == SNMP_ERROR_NOSUCHNAME and
+                0 < error_index <= len(pending)):
+                del pending[error_index - 1]
+                continue
+            elif error_status == SNMP_ERROR_NOSUCHNAME:
+                break
+            elif error_status == SNMP_ERROR_TOOBIG and len(pending) > 1:
+                half = len(pending) // 2
+                for part in (pending[:half], pending[half:]):
+                    for position, varbind in zip(part, self.get(
+                        [oids[position] for position in part], stats)):
+                        results[position] = varbind
+                break
+            elif error_status:
+                raise SnmpError('Error in packet, error-status: %s'
+                                % (error_status))
+
+            for position, varbind in zip(pending, varbinds):
+                results[position] = varbind
+            break
+
+        return [results[position] for position in range(len(oids))]
+
+    def walk(self, oid, stats=None):
+        '''
+        Walk the subtree under oid using GETNEXT, returns a list of
+        (oid, value) tuples. Like snmpwalk, stops at the end of the
+        subtree, the end of the MIB view or a non-increasing OID.
+        '''
+        root = oid.strip('.')
+        current = root
+        results = []
+
+        while True:
+            error_status, error_index, varbinds = self.request(
+                PDU_GETNEXT, [current], stats=stats)
+            if error_status or not varbinds:
+                break
+
+            next_oid, value = varbinds[0]
+
+            if (not _oid_in_subtree(next_oid, root) or
+                value == END_OF_MIB_VIEW):
+                break
+
+            if _oid_tuple(next_oid) <= _oid_tuple(current):
+                break
+
+            results.append((next_oid, value))
+            current = next_oid
+
+        return results
+
+    def table(self, columns, max_repetitions=None, stats=None):
+        '''
+        Fetch several columns of a table together. Every PDU carries one
+        varbind per unfinished column, GETBULK is used on SNMPv2c agents
+        and multi-varbind GETNEXT on SNMPv1 agents. Each GETBULK asks for
+        max_repetitions rows, by default as many as make up
+        max_bulk_varbinds varbinds, so fewer columns give more rows.
+
+        Returns a dictionary keyed by the table index (the part of the OID
+        after the column) of lists holding one value per column, cells
+        the agent did not return are None.
+        '''
+        roots = [column.strip('.') for column in columns]
+        current = list(roots)
+        active = range(len(roots))
+        rows = {}
+
+        while active:
+            oids = [current[column] for column in active]
+
+            if self.version:
+                error_status, error_index, varbinds = self.request(
+                    PDU_GETBULK, oids, 0,
+                    max_repetitions or max(1, self.max_bulk_varbinds //
+                                           len(oids)), stats)
+            else:
+                error_status, error_index, varbinds = self.request(
+                    PDU_GETNEXT, oids, stats=stats)
+
+            if error_status or not varbinds:
+                break
+
+            finished = set()
+
+            # Varbinds come back row by row, one per requested column
+            for position, (oid, value) in enumerate(varbinds):
+                column = active[position % len(active)]
+
+                if column in finished:
+                    continue
+
+                if (not _oid_in_subtree(oid, roots[column]) or
+                    value == END_OF_MIB_VIEW or
+                    _oid_tuple(oid) <= _oid_tuple(current[column])):
+                    finished.add(column)
+                    continue
+
+                index = oid[len(roots[column]) + 1:]
+                rows.setdefault(index, [None] * len(roots))[column] = value
+                current[column] = oid
+
+            active = [column for column in active if column not in finished]
+
+        return rows
+
+def _from_json(value, encoding='utf-8'):
+    '''
+    For internal use, json hands back unicode, the rest of the plugin
+    deals in byte strings. Encodes every string found in value.
+
+    >>> _from_json([u'a', {u'b': 1}])
+    ['a', {'b': 1}]
+    '''
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    elif isinstance(value, list):
+        return [_from_json(item, encoding) for item in value]
+    elif isinstance(value, dict):
+        return dict([(_from_json(name, encoding), _from_json(item, encoding))
+                     for name, item in value.items()])
+
+    return value
+
+
+class SnmpSession(object):
+    '''
+    A file of recorded SNMP answers, one JSON object per line. In record
+    mode every raw answer is appended as it arrives, in replay mode the
+    answers are handed back for the same agent, request and OIDs without
+    touching the network. Repeated requests are answered in the order
+    they were recorded, the last answer is repeated once they run out.
+
+    The subprocess backend records the text output of the net-snmp
+    tools and the native backend the undecoded values from the engine,
+    so a replay goes through all of the parsing and decoding again.
+
+    There are two arguments that are passed to the init constructor:
+
+    file_path: a string, the session file
+    mode: a string, either 'record' or 'replay'
+    '''
+
+    def __init__(self, file_path, mode='replay'):
+
+        self.file_path = file_path
+        self.mode = mode
+        self.lock = threading.Lock()
+
+        # (agent, kind, request, oids): [answer, ...] and agent: kind
+        self.answers = {}
+        self.backends = {}
+
+        if mode == 'replay':
+            for line in open(file_path):
+                if line.strip():
+                    self._add(json.loads(line))
+
+    def _add(self, entry):
+        '''
+        For internal use, indexes one recorded entry for replay.
+        '''
+        # latin-1 gives back exactly the bytes that were recorded
+        entry = _from_json(entry, 'latin-1')
+        key = (entry['agent'], entry['kind'], entry['request'],
+               tuple(entry['oids']))
+
+        self.answers.setdefault(key, []).append(entry['raw'])
+        self.backends.setdefault(entry['agent'], entry['kind'])
+
+        return None
+
+    def backend(self, agent):
+        '''
+        Returns the backend the answers for agent were recorded with,
+        'native' or 'subprocess'.
+        '''
+        return self.backends.get(agent, 'native')
+
+    def record(self, agent, kind, request, oids, raw):
+        '''
+        Append one raw answer to the session file. kind is the backend,
+        request the engine method or net-snmp command.
+        '''
+        entry = {'agent':agent, 'kind':kind, 'request':request,
+                 'oids':list(oids), 'raw':raw, 'time':time.time()}
+
+        with self.lock:
+            sessionFile = open(self.file_path, 'a')
+            try:
+                sessionFile.write(json.dumps(entry, encoding='latin-1') +
+                                  '\n')
+            finally:
+                sessionFile.close()
+
+        return None
+
+    def replay(self, agent, kind, request, oids):
+        '''
+        Returns the next recorded raw answer for the request, raises
+        SnmpError if there is none.
+        '''
+        with self.lock:
+            answers = self.answers.get((agent, kind, request, tuple(oids)))
+
+            if not answers:
+                raise SnmpError('No recorded answer for %s %s %s'
+                                % (agent, request, ' '.join(oids)))
+
+            if len(answers) > 1:
+                return answers.pop(0)
+
+            return answers[0]
+
+
+class RecordingEngine(object):
+    '''
+    Wraps an SnmpEngine and records every answer it gets to an
+    SnmpSession.
+    '''
+
+    def __init__(self, engine, session):
+
+        self.engine = engine
+        self.session = session
+
+    def _record(self, request, oids, raw):
+        '''
+        For internal use, records raw and hands it back.
+        '''
+        self.session.record(self.engine.agent, 'native', request, oids, raw)
+
+        return raw
+
+    def get_latency(self):
+        '''
+        Returns the latency of the wrapped engine, see SnmpEngine.
+        '''
+        return self.engine.get_latency()
+
+    def set_latency(self, srtt, rttvar):
+        '''
+        Starts the wrapped engine from a latency seen before.
+        '''
+        return self.engine.set_latency(srtt, rttvar)
+
+    def get(self, oids, stats=None):
+        '''
+        GETs the list oids with the wrapped engine and records the answer.
+        '''
+        return self._record('get', oids, self.engine.get(oids, stats))
+
+    def walk(self, oid, stats=None):
+        '''
+        Walks the subtree oid with the wrapped engine and records the
+        answer.
+        '''
+        return self._record('walk', [oid], self.engine.walk(oid, stats))
+
+    def table(self, columns, max_repetitions=None, stats=None):
+        '''
+        Fetches the table columns with the wrapped engine and records the
+        answer.
+        '''
+        return self._record('table', columns,
+                            self.engine.table(columns, max_repetitions,
+                                              stats))
+
+
+class ReplayEngine(object):
+    '''
+    Stands in for an SnmpEngine, answering from an SnmpSession.
+    '''
+
+    def __init__(self, agent, session):
+
+        self.agent = agent
+        self.session = session
+
+    def get_latency(self):
+        '''
+        A replay has no latency, always returns (None, None).
+        '''
+        return None, None
+
+    def set_latency(self, srtt, rttvar):
+        '''
+        Does nothing, a replay never waits for an answer.
+        '''
+        return None
+
+    def get(self, oids, stats=None):
+        '''
+        Returns the recorded answer to a GET of the list oids.
+        '''
+        return self.session.replay(self.agent, 'native', 'get', oids)
+
+    def walk(self, oid, stats=None):
+        '''
+        Returns the recorded answer to a walk of the subtree oid.
+        '''
+        return self.session.replay(self.agent, 'native', 'walk', [oid])
+
+    def table(self, columns, max_repetitions=None, stats=None):
+        '''
+        Returns the recorded answer to a fetch of the table columns.
+        '''
+        return self.session.replay(self.agent, 'native', 'table', columns)
+
+
+def _file_name(text):
+    '''
+    For internal use, turns an agent or sensor name into something safe
+    to use as a file name.
+
+    >>> _file_name('raid1.example.com:16100')
+    'raid1.example.com_16100'
+    '''
+    return ''.join([character if character.isalnum() or character in '.-'
+                    else '_' for character in text])
+
+
+def _private_directory(path):
+    '''
+    For internal use, makes sure path is a directory only its owner, the
+    user running the plugin, can write to, creating it with mode 0700 if
+    it does not exist. Raises OSError if it is anything else, such as a
+    directory another user created ahead of us, or a symlink.
+
+    >>> directory = os.path.join(tempfile.mkdtemp(), 'cache')
+    >>> _private_directory(directory)
+    >>> oct(stat.S_IMODE(os.stat(directory).st_mode))
+    '0700'
+    >>> os.chmod(directory, 0777)
+    >>> _private_directory(directory) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    OSError: ... is writable by other users
+    '''
+    if not os.path.lexists(path):
+        os.makedirs(path, 0700)
+
+    status = os.lstat(path)
+
+    if not stat.S_ISDIR(status.st_mode):
+        raise OSError('%s is not a directory' % (path))
+    elif status.st_uid != os.geteuid():
+        raise OSError('%s is owned by another user' % (path))
+    elif status.st_mode & 022:
+        raise OSError('%s is writable by other users' % (path))
+
+    return None
+
+
+class StateCache(object):
+    '''
+    A small JSON file of values kept between runs for one agent. Every
+    value is stored along with the time it was set so that each reader
+    can apply its own time to live. Changes are kept in memory until
+    flush writes the file, once per run. Failing to read or write the
+    file is never fatal, the cache simply behaves as if it was empty.
+
+    There are two arguments that are passed to the init constructor:
+
+    cache_dir: a string, the directory holding the cache files
+    agent: a string, the agent the values belong to
+    '''
+
+    def __init__(self, cache_dir, agent):
+
+        self.file_path = os.path.join(cache_dir, _file_name(agent) + '.json')
+        self.lock = threading.Lock()
+        self.data = None
+
+        # Whether data has changed since the file was last written
+        self.dirty = False
+
+    def _load(self):
+        '''
+        For internal use, reads the cache file the first time it is
+        needed.
+        '''
+        if self.data is None:
+            try:
+                cacheFile = open(self.file_path)
+                try:
+                    self.data = json.load(cacheFile)
+                finally:
+                    cacheFile.close()
+            except (IOError, ValueError):
+                self.data = {}
+
+            if not isinstance(self.data, dict):
+                self.data = {}
+
+        return self.data
+
+    def _save(self):
+        '''
+        For internal use, writes the cache file atomically so concurrent
+        runs never see half a file.
+        '''
+        try:
+            directory = os.path.dirname(self.file_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+
+            descriptor, tmpPath = tempfile.mkstemp(dir=directory)
+            tmpFile = os.fdopen(descriptor, 'w')
+            try:
+                json.dump(self.data, tmpFile)
+            finally:
+                tmpFile.close()
+
+            os.rename(tmpPath, self.file_path)
+        except (IOError, OSError, ValueError):
+            # ValueError covers strings json can not encode
+            pass
+
+        return None
+
+    def get(self, key, ttl=None):
+        '''
+        Return the value stored under key, or None if there is none or it
+        is older than ttl seconds.
+        '''
+        with self.lock:
+            entry = self._load().get(key)
+
+        if not entry:
+            return None
+
+        if ttl is not None and time.time() - entry[0] > ttl:
+            return None
+
+        return _from_json(entry[1])
+
+    def set(self, key, value):
+        '''
+        Store value under key, it is written out by flush.
+        '''
+        with self.lock:
+            self._load()[key] = [time.time(), value]
+            self.dirty = True
+
+        return None
+
+    def age(self, key):
+        '''
+        Return how many seconds ago key was set, or None if it is not set.
+        '''
+        with self.lock:
+            entry = self._load().get(key)
+
+        if not entry:
+            return None
+
+        return time.time() - entry[0]
+
+    def delete(self, key):
+        '''
+        Remove key from the cache, it is written out by flush.
+        '''
+        with self.lock:
+            if self._load().pop(key, None) is not None:
+                self.dirty = True
+
+        return None
+
+    def flush(self):
+        '''
+        Write the cache out if anything has changed.
+        '''
+        with self.lock:
+            if self.dirty:
+                self._save()
+                self.dirty = False
+
+        return None
+
+
+class SensorHistory(object):
+    '''
+    A ring of the last capacity (timestamp, value) records of one sensor
+    of one agent, in a memory mapped file. The header holds the capacity
+    and the number of records ever appended and every record is two
+    doubles at a fixed offset, so appending and reading the last few
+    minutes never parse anything and cost the same with months of
+    history behind them. Failing to open the file is never fatal, the
+    history is simply empty.
+
+    There are four arguments that are passed to the init constructor:
+
+    history_dir: a string, the directory holding a directory per agent
+    agent: a string, the agent the sensor belongs to
+    sensor: a string, the name of the sensor
+    capacity: an integer, records kept, only used to create the file
+
+    >>> historyDir = tempfile.mkdtemp()
+    >>> history = SensorHistory(historyDir, 'raid1', 'Temp 1', capacity=2)
+    >>> for second in range(3):
+    ...     history.append(100 + second, 40 + second)
+    >>> history.values(0)
+    [(101.0, 41.0), (102.0, 42.0)]
+    >>> history.values(102)
+    [(102.0, 42.0)]
+    >>> history.close()
+    '''
+
+    magic = 'IFRB'
+    header = struct.Struct('<4sQQ')
+    record = struct.Struct('<dd')
+
+    def __init__(self, history_dir, agent, sensor, capacity=32768):
+
+        self.file_path = os.path.join(history_dir, _file_name(agent),
+                                      _file_name(sensor) + '.ring')
+        self.capacity = capacity
+        self.map = None
+
+        try:
+            self._open()
+        except EnvironmentError:
+            self.map = None
+
+    def _open(self):
+        '''
+        For internal use, maps the file, creating it if need be. A file of
+        another capacity is used as it is.
+        '''
+        directory = os.path.dirname(self.file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        # Never follow a symlink planted in place of the file
+        descriptor = os.open(self.file_path, os.O_RDWR | os.O_CREAT |
+                             os.O_NOFOLLOW, 0600)
+
+        try:
+            status = os.fstat(descriptor)
+            if not stat.S_ISREG(status.st_mode):
+                raise OSError('%s is not a regular file' % (self.file_path))
+
+            size = status.st_size
+            magic = capacity = None
+
+            if size >= self.header.size:
+                magic, capacity, appended = self.header.unpack(
+                    os.read(descriptor, self.header.size))
+
+            if (magic != self.magic or
+                size != self.header.size + capacity * self.record.size):
+                capacity = self.capacity
+                size = self.header.size + capacity * self.record.size
+                os.ftruncate(descriptor, 0)
+                os.ftruncate(descriptor, size)
+                os.lseek(descriptor, 0, os.SEEK_SET)
+                os.write(descriptor, self.header.pack(self.magic, capacity,
+                                                      0))
+
+            self.capacity = capacity
+            self.map = mmap.mmap(descriptor, size)
+        finally:
+            os.close(descriptor)
+
+        return None
+
+    def append(self, timestamp, value):
+        '''
+        Add a record, overwriting the oldest once the ring is full.
+        '''
+        if self.map is None:
+            return None
+
+        magic, capacity, appended = self.header.unpack_from(self.map)
+        self.record.pack_into(self.map, self.header.size +
+                              (appended % capacity) * self.record.size,
+                              timestamp, value)
+        self.header.pack_into(self.map, 0, magic, capacity, appended + 1)
+
+        return None
+
+    def values(self, since):
+        '''
+        Returns the (timestamp, value) records from since onwards, oldest
+        first. Only those records are read.
+        '''
+        if self.map is None:
+            return []
+
+        magic, capacity, appended = self.header.unpack_from(self.map)
+        records = []
+
+        for number in xrange(appended - 1, max(appended - capacity, 0) - 1,
+                             -1):
+            timestamp, value = self.record.unpack_from(
+                self.map, self.header.size +
+                (number % capacity) * self.record.size)
+
+            if timestamp < since:
+                break
+
+            records.append((timestamp, value))
+
+        records.reverse()
+
+        return records
+
+    def close(self):
+        '''
+        Unmap the file.
+        '''
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+        return None
+
+
+def parse_thresholds(text):
+    '''
+    Parse a WARN:CRIT pair of thresholds, either may be left out.
+    Returns a tuple of two floats or None. Raises ValueError for
+    anything else.
+
+    >>> parse_thresholds('5:8')
+    (5.0, 8.0)
+    >>> parse_thresholds(':8')
+    (None, 8.0)
+    >>> parse_thresholds('5')
+    (5.0, None)
+    '''
+    parts = text.split(':')
+
+    if len(parts) > 2:
+        raise ValueError('Expected WARN:CRIT, got %s' % (text))
+
+    parts += [''] * (2 - len(parts))
+
+    return tuple([float(part) if part else None for part in parts])
+
+
+class Snmp(object):
+    '''
+    A Basic Class for an SNMP session
+    '''
+    def __init__(self, version='2c', agent='localhost',
+                 community='public', verbose=0, backend='native', workers=1,
+                 session=None, socket_pool=0):
+
+        self.community = community
+        self.agent = agent
+        self.verbose = verbose
+        self.version = version
+        self.backend = backend
+
+        # Number of independent queries allowed in flight at once
+        self.workers = workers
+
+        # SnmpSession to record to, or replay from with backend 'replay'
+        self.session = session
+        if backend == 'replay' and session is None:
+            raise CheckError('The replay backend needs a session file.',
+                             UNKNOWN)
+
+        # In-process engine, created on first use
+        self._engine = None
+
+        # Sockets the engine shares with every other session of this
+        # process, 0 for a socket per request
+        self.socket_pool = socket_pool
+
+        # The deadline of the current run, queries never wait past it
+        self.deadline = Deadline()
+
+        # Timing of every query, and the phase of the check it belongs to
+        self.trace = []
+        self.phase = None
+
+    def query(self, snmp_command, oid):
+        '''
+        Creates an SNMP query session.
+
+        snmpcmd is a required string that can either be 'snmpget'
+        or 'snmpwalk'.
+
+        oid is a required string that is the numerical OID to be used.
+
+        The query is answered by the in-process engine unless the backend
+        is 'subprocess', in which case the net-snmp tools are run.
+        '''
+
+        stats = self._start_trace()
+        result = None
+
+        try:
+            if self._uses_subprocess():
+                result = self._query_subprocess(snmp_command, oid, stats)
+            else:
+                result = self._query_native(snmp_command, oid, stats)
+        finally:
+            self._finish_trace(stats, snmp_command, [oid], result)
+
+        return result
+
+    def _start_trace(self):
+        '''
+        For internal use, returns the counters for a query about to start.
+        '''
+        return {'start':time.time(), 'requests':0, 'retries':0, 'bytes':0,
+                'spawns':0}
+
+    def _finish_trace(self, stats, snmp_command, oids, result):
+        '''
+        For internal use, records the timing of a finished query. result
+        is what the query returned, None if it failed.
+        '''
+        if isinstance(result, (list, dict)):
+            rows = len(result)
+        else:
+            rows = int(result is not None)
+
+        stats.update({'phase':self.phase, 'command':snmp_command,
+                      'oids':oids, 'rows':rows, 'error':result is None,
+                      'time':time.time() - stats['start']})
+        self.trace.append(stats)
+
+        if self.verbose > 1:
+            print ('Debug2: %s %s took %.3fs, %s bytes, %s rows, '
+                   '%s retries') % (snmp_command, ' '.join(oids),
+                                    stats['time'], stats['bytes'], rows,
+                                    stats['retries'])
+
+        return None
+
+    def trace_summary(self):
+        '''
+        Returns the query timings added up per phase, a dictionary of
+        phase to a dictionary of totals.
+        '''
+        summary = {}
+
+        for record in self.trace:
+            totals = summary.setdefault(record['phase'],
+                                        {'queries':0, 'time':0.0,
+                                         'requests':0, 'retries':0,
+                                         'bytes':0, 'rows':0, 'spawns':0})
+            totals['queries'] += 1
+            for counter in ('time', 'requests', 'retries', 'bytes', 'rows',
+                            'spawns'):
+                totals[counter] += record[counter]
+
+        return summary
+
+    def _get_engine(self):
+        '''
+        For internal use, returns the in-process SNMP engine for this
+        session, creating it if need be.
+        '''
+        if self._engine is None:
+            if self.backend == 'replay':
+                self._engine = ReplayEngine(self.agent, self.session)
+                return self._engine
+
+            transport = None
+            if self.socket_pool:
+                transport = shared_transport(self.socket_pool)
+
+            try:
+                engine = SnmpEngine(self.agent, self.community, self.version,
+                                    deadline=self.deadline,
+                                    transport=transport)
+            except SnmpError, error:
+                raise CheckError('Error: %s exiting!' % (error))
+
+            if self.session:
+                engine = RecordingEngine(engine, self.session)
+
+            self._engine = engine
+
+        return self._engine
+
+    def _uses_subprocess(self):
+        '''
+        For internal use, True if queries go through the net-snmp tools,
+        or are replayed from a session recorded with them.
+        '''
+        if self.backend == 'replay':
+            return self.session.backend(self.agent) == 'subprocess'
+
+        return self.backend == 'subprocess'
+
+    def _query_native(self, snmp_command, oid, stats=None):
+        '''
+        For internal use, answers a query with the in-process engine and
+        returns the same values _parse_snmp_output would.
+        '''
+        engine = self._get_engine()
+
+        if self.verbose > 1:
+            print 'Debug2: Performing SNMP query:', snmp_command, oid
+
+        try:
+            if snmp_command == 'snmpget':
+                values = [value for name, value in engine.get([oid], stats)]
+            elif snmp_command == 'snmpwalk':
+                values = [value for name, value in engine.walk(oid, stats)]
+
+                # Like snmpwalk, try the OID itself if the subtree is empty
+                if not values:
+                    values = [value for name, value
+                              in engine.get([oid], stats)]
+            else:
+                raise CheckError('%s is not supported by the native '
+                                 'backend.' % (snmp_command))
+        except SnmpError, error:
+            raise _check_error(error)
+
+        final_output = [self._clean_value(value) for value in values]
+
+        if snmp_command == 'snmpget':
+            final_output = final_output[0]
+
+        if self.verbose > 1:
+            print ('Debug2: Final output after cleaning:'
+                   '%s') % (final_output)
+
+        return final_output
+
+    def query_all(self, queries):
+        '''
+        Runs several independent queries, given as a list of
+        (snmp_command, oid) tuples, and returns their results in order.
+        Up to self.workers of them are in flight at once.
+        '''
+        return _run_concurrently([lambda query=query: self.query(*query)
+                                  for query in queries], self.workers)
+
+    def query_many(self, oids):
+        '''
+        GETs every OID in the list oids and returns their values in the
+        same order. The native backend sends one multi-varbind GET, the
+        subprocess backend one snmpget per SnmpEngine.max_varbinds OIDs
+        for SNMPv2c and parallel snmpgets for SNMPv1, where one missing
+        variable fails the whole request.
+        '''
+
+        if self.verbose > 1:
+            print 'Debug2: Performing SNMP multiple get:', oids
+
+        if self._uses_subprocess():
+            if self.version == '1':
+                return self.query_all([('snmpget', oid) for oid in oids])
+
+            # snmpget takes a limited number of OIDs, and agents answer
+            # big requests with tooBig
+            size = SnmpEngine.max_varbinds
+            chunks = _run_concurrently([lambda start=start:
+                                        self._get_many_subprocess(
+                                            oids[start:start + size])
+                                        for start in range(0, len(oids),
+                                                           size)],
+                                       self.workers)
+
+            return list(itertools.chain(*chunks))
+
+        engine = self._get_engine()
+        stats = self._start_trace()
+        values = None
+
+        try:
+            values = [self._clean_value(value)
+                      for name, value in engine.get(oids, stats)]
+        except SnmpError, error:
+            raise _check_error(error)
+        finally:
+            self._finish_trace(stats, 'snmpget', oids, values)
+
+        if self.verbose > 1:
+            print 'Debug2: Final output after cleaning:', values
+
+        return values
+
+    def _get_many_subprocess(self, oids):
+        '''
+        For internal use, GETs every OID in the list oids with one
+        snmpget and returns their values in the same order. Should the
+        output not hold a value for each, every OID is asked for alone.
+        '''
+
+        stats = self._start_trace()
+        values = None
+        try:
+            output = self._run_snmp_command('snmpget', oids, stats)
+            values = self._parse_snmp_output('snmpwalk', output)
+        finally:
+            self._finish_trace(stats, 'snmpget', oids, values)
+
+        if len(values) == len(oids):
+            return values
+
+        return self.query_all([('snmpget', oid) for oid in oids])
+
+    def query_table(self, oids):
+        '''
+        Fetches the table columns given in the list oids together.
+
+        Returns a dictionary keyed by the table index of lists holding
+        one value per column, missing cells are None. The native backend
+        gets all of the columns at once with GETBULK, the subprocess
+        backend walks each column with numeric OIDs to learn the index of
+        every value.
+        '''
+
+        if self.verbose > 1:
+            print 'Debug2: Performing SNMP table query:', oids
+
+        if self._uses_subprocess():
+            rows = {}
+            columns = _run_concurrently([lambda oid=oid:
+                                         self._walk_column_subprocess(oid)
+                                         for oid in oids], self.workers)
+            for column, values in enumerate(columns):
+                for index, value in values:
+                    rows.setdefault(index, [None] * len(oids))[column] = value
+
+            return rows
+
+        engine = self._get_engine()
+        stats = self._start_trace()
+        rows = None
+
+        try:
+            rows = engine.table(oids, stats=stats)
+        except SnmpError, error:
+            raise _check_error(error)
+        finally:
+            self._finish_trace(stats, 'snmpbulkwalk', oids, rows)
+
+        for index in rows:
+            rows[index] = [self._clean_value(value) for value in rows[index]]
+
+        if self.verbose > 1:
+            print 'Debug2: Final table after cleaning:', rows
+
+        return rows
+
+    def _clean_value(self, value):
+        '''
+        For internal use, strips strings the same way _parse_snmp_output
+        does and passes everything else through.
+
+        >>> s = Snmp()
+        >>> s._clean_value(' Notification        ')
+        'Notification'
+        >>> s._clean_value(64)
+        64
+        '''
+        if isinstance(value, str):
+            return value.strip()
+
+        return value
+
+    def _walk_column_subprocess(self, oid):
+        '''
+        For internal use, walks the table column oid with snmpwalk and
+        returns a list of (index, value) tuples.
+        '''
+
+        stats = self._start_trace()
+        result = None
+
+        try:
+            result = self._parse_numeric_walk(oid, self._stream_snmp_command(
+                'snmpwalk', [oid], stats, numeric=True))
+        finally:
+            self._finish_trace(stats, 'snmpwalk', [oid], result)
+
+        return result
+
+    def _parse_numeric_walk(self, oid, lines):
+        '''
+        For internal use, parses the lines snmpwalk -O n printed for the
+        column oid into a list of (index, value) tuples. Lines outside the
+        column, such as No Such Object for a missing one, are left out.
+
+        >>> s = Snmp()
+        >>> s._parse_numeric_walk('1.3.6.1.4.1.1714.1.9.1.8',
+        ...     ['.1.3.6.1.4.1.1714.1.9.1.8.2 = STRING: "Fan: 1"',
+        ...      '.1.3.6.1.4.1.1714.1.9.1.8.5 = INTEGER: 3'])
+        [('2', 'Fan: 1'), ('5', 3)]
+        >>> s._parse_numeric_walk('1.3.6.1.4.1.1714.1.9.1.8',
+        ...     ['.1.3.6.1.4.1.1714.1.9.1.8 = No Such Object available on '
+        ...      'this agent at this OID'])
+        []
+        '''
+
+        prefix = '.' + oid.strip('.') + '.'
+        indexes = []
+        values = []
 
-        self.community = community
-        self.agent = agent
-        self.verbose = verbose
-        self.version = version
+        for line in lines:
+            name, separator, value = line.partition(' = ')
 
-    def query(self, snmp_command, oid):
+            if not separator or not name.startswith(prefix):
+                continue
+
+            indexes.append(name[len(prefix):])
+            values.append(value)
+
+        return zip(indexes, self._iter_snmp_values(values))
+
+    def _query_subprocess(self, snmp_command, oid, stats=None):
+        '''
+        For internal use, runs the net-snmp command line tools to answer
+        the query.
         '''
-        Creates an SNMP query session.
 
-        snmpcmd is a required string that can either be 'snmpget'
-        or 'snmpwalk'.
+        lines = self._stream_snmp_command(snmp_command, [oid], stats)
 
-        oid is a required string that is the numerical OID to be used.
+        # Only the first line of a get is parsed, the rest is read as well
+        # so that the deadline is checked and the whole answer recorded
+        if snmp_command == 'snmpget':
+            lines = list(lines)
+
+        return self._parse_snmp_output(snmp_command, lines)
+
+    def _run_snmp_command(self, snmp_command, oids, stats=None):
+        '''
+        For internal use, runs a net-snmp command line tool against the
+        list of oids and returns its raw output. If a stats dictionary
+        is passed its spawns and bytes counters are increased.
+        '''
+
+        return '\n'.join(self._stream_snmp_command(snmp_command, oids, stats))
+
+    def _stream_snmp_command(self, snmp_command, oids, stats=None,
+                             numeric=False):
         '''
+        For internal use, runs a net-snmp command line tool against the
+        list of oids and yields its output a line at a time as it is read
+        from the pipe, trimmed the way the whole output used to be
+        stripped. If a stats dictionary is passed its spawns and bytes
+        counters are increased. Only the values are printed, unless
+        numeric is True, then every line starts with the numeric OID.
+        The output is recorded, and the deadline checked, only once it
+        has been read to the end.
+        '''
+
+        # Recorded apart, the two print different output for the same query
+        recordedCommand = snmp_command
+        outputOptions = ' -O v '
+        if numeric:
+            recordedCommand = snmp_command + ' -On'
+            outputOptions = ' -O n '
+
+        if self.backend == 'replay':
+            try:
+                output = self.session.replay(self.agent, 'subprocess',
+                                             recordedCommand, oids)
+            except SnmpError, error:
+                raise CheckError(str(error))
+
+            for line in output.split('\n'):
+                yield line
+
+            return
 
         full_snmp_command = self._which(snmp_command)
 
         if not full_snmp_command:
-            print snmp_command, ('is not available in your path, or is not '
-                                 'executable by you, exiting.')
-            sys.exit(CRITICAL)
+            raise CheckError('%s is not available in your path, or is not '
+                             'executable by you, exiting.' % (snmp_command))
 
-        command_line = ('%s -v %s -O v -c %s %s %s')
+        command_line = ('%s -v %s' + outputOptions + '-c %s %s %s')
 
         command_line = command_line % (snmp_command, self.version,
-                                       self.community, self.agent, oid,)
+                                       self.community, self.agent,
+                                       ' '.join(oids),)
+
+        # Fit the tool's own timeout and retries into what is left of the
+        # deadline, and kill it should it still overrun
+        remaining = self.deadline.remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise CheckTimeout('Timeout: Deadline of %ss reached'
+                                   % (self.deadline.seconds))
+
+            attemptTimeout = min(1.0, remaining)
+            command_line = command_line.replace(
+                outputOptions, outputOptions + '-t %.2f -r %d '
+                % (attemptTimeout, min(5, int(remaining / attemptTimeout) - 1)),
+                1)
 
         if self.verbose > 1:
             print 'Debug2: Performing SNMP query:', command_line
 
         try:
-            p = subprocess.Popen(command_line, shell=True,
+            # exec so that killing the shell kills the tool
+            p = subprocess.Popen('exec ' + command_line, shell=True,
                                  stdout = subprocess.PIPE,
                                  stderr = subprocess.STDOUT)
         except OSError:
-            print 'Error:', sys.exc_info, 'exiting!'
-            sys.exit(WARNING)
+            raise CheckError('Error: %s exiting!' % (sys.exc_info()[1]),
+                             WARNING)
 
-        # This is where we sanitize the output gathered.
+        if stats is not None:
+            stats['spawns'] += 1
 
-        output = p.stdout.read().strip()
+        killer = None
+        if remaining is not None:
+            killer = threading.Timer(remaining, p.kill)
+            killer.daemon = True
+            killer.start()
 
-        if self.verbose > 1:
-            print 'Debug2: Raw output obtained from query:', output
+        # Only kept when the output has to be recorded
+        recorded = []
+
+        # Blank lines are held back until a line with something on it
+        # follows, trailing ones are dropped
+        started = False
+        blank = []
+
+        try:
+            for line in iter(p.stdout.readline, ''):
+                if stats is not None:
+                    stats['bytes'] += len(line)
+
+                line = line.rstrip('\r\n')
+
+                if not started:
+                    line = line.lstrip()
+                    if not line:
+                        continue
+                    started = True
+
+                if not line.strip():
+                    blank.append(line)
+                    continue
+
+                # What the tools print once their retries are used up
+                if line.startswith('Timeout: No Response'):
+                    raise CheckTimeout(line)
+
+                for held in blank + [line]:
+                    if self.session:
+                        recorded.append(held)
+
+                    if self.verbose > 1:
+                        print 'Debug2: Raw output obtained from query:', held
+
+                    yield held
+
+                blank = []
+
+            # The whole output was blank
+            if not started:
+                yield ''
+        finally:
+            if killer:
+                killer.cancel()
+                # Lest it outlive an interpreter about to exit
+                killer.join()
+
+            # The caller may stop reading early
+            if p.poll() is None:
+                p.kill()
+
+            p.stdout.close()
+            p.wait()
+
+        if self.deadline.expired():
+            raise CheckTimeout('Timeout: Deadline of %ss reached'
+                               % (self.deadline.seconds))
 
-        return self._parse_snmp_output(snmp_command, output)
+        if self.session:
+            self.session.record(self.agent, 'subprocess', recordedCommand,
+                                oids, '\n'.join(recorded))
 
     def _parse_snmp_output(self, snmp_command, output):
         '''
         Parse the SNMP output and return values as integers or strings.
         Returns a list of items for walk and a single item for gets.
+        output is either the whole output or an iterable of its lines.
 
         Doctests Follow:
         >>> s = Snmp()
@@ -159,20 +2265,51 @@ class Snmp(object):
 
         Walks of integers should return a list of integers:
 
-        >>> s._parse_snmp_output('snmpwalk', 'INTEGER: 0\nINTEGER: 64')
+        >>> s._parse_snmp_output('snmpwalk', 'INTEGER: 0\\nINTEGER: 64')
         [0, 64]
 
         Walks of strings should return a list of strings:
 
-        >>> s._parse_snmp_output('snmpwalk', ('STRING: "Any Source"\n'
+        >>> s._parse_snmp_output('snmpwalk', ('STRING: "Any Source"\\n'
         ...                                   'STRING: "Notification"'))
         ['Any Source', 'Notification']
+
+        Strings holding colons should be returned whole:
+
+        >>> s._parse_snmp_output('snmpget', 'STRING: "Sun Jan 1 12:00:00"')
+        'Sun Jan 1 12:00:00'
+        '''
+        if isinstance(output, basestring):
+            output = output.split('\n')
+
+        values = self._iter_snmp_values(output)
+
+        if snmp_command == 'snmpget':
+            final_output = values.next()
+        else:
+            final_output = list(values)
+
+        if self.verbose > 1:
+            print ('Debug2: Final output after cleaning:'
+                   '%s') % (final_output)
+
+        return final_output
+
+    def _iter_snmp_values(self, lines):
+        '''
+        For internal use, a generator turning lines of net-snmp output
+        into integers and strings, one value per line. Only the first
+        colon separates the type from the value, values may hold more.
+
+        >>> s = Snmp()
+        >>> list(s._iter_snmp_values(['INTEGER: 3', 'STRING: "12:30:01"',
+        ...                           'Timeticks: (100) 0:00:01.00']))
+        [3, '12:30:01', ' (100) 0:00:01.00']
         '''
-        final_output = []
 
-        for item in output.split('\n'):
+        for item in lines:
             try:
-                style, value = item.split(':')
+                style, value = item.split(':', 1)
             except ValueError:
                 # If exception occurs this is probably a warning message
                 # pass through.
@@ -180,22 +2317,13 @@ class Snmp(object):
                 value = item
 
             if style == 'INTEGER':
-                final_output.append(int(value))
+                yield int(value)
             elif style == 'STRING':
                 # Strip whitespace, quotes, then whitespace again
-                final_output.append(value.strip().strip('"').strip())
+                yield value.strip().strip('"').strip()
             else:
                 # We treat any unknowns as strings
-                final_output.append(value)
-
-        if snmp_command == 'snmpget':
-            final_output = final_output[0]
-
-        if self.verbose > 1:
-            print ('Debug2: Final output after cleaning:'
-                   '%s') % (final_output)
-
-        return final_output
+                yield value
 
     def _test(self):
         '''
@@ -232,6 +2360,176 @@ class Snmp(object):
         return None
 
 
+def _import_numpy():
+    '''
+    For internal use, numpy is optional and only imported when the luDev
+    table is to be evaluated with it. Returns the module or None.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        return None
+
+    return numpy
+
+
+def _compile_status_rules(rules):
+    '''
+    For internal use, turns the rules of one device type into
+    (shift, mask, outcomes) tuples.
+
+    >>> _compile_status_rules([(2, 2, {3:('Drained', 'critical')})])
+    [(2, 3, {3: ('Drained', 'critical')})]
+    '''
+    return [(lowBit, (1 << width) - 1, outcomes)
+            for lowBit, width, outcomes in rules]
+
+
+# luDev type: compiled rules, and (luDev type, status): decoded status
+_compiledStatusRules = dict([(deviceType, _compile_status_rules(rules))
+                             for deviceType, rules in
+                             luDevStatusRules.items()])
+_decodedStatuses = {}
+
+
+def decode_status(deviceType, status):
+    '''
+    Decode a luDev status with the rules of its device type, returns a
+    tuple of (message, severity) in bit order. The same few status codes
+    turn up on every row of every array so the results are memoized.
+
+    >>> decode_status(3, 7)
+    (('Temperature sensor is malfunctioning', 'critical'), ('Hot temperature warning', 'warning'))
+    >>> decode_status(11, 0x42)
+    (('Battery charging on', None), ('Battery-backup is disabled', None))
+    >>> decode_status(2, 0)
+    ()
+    '''
+    try:
+        return _decodedStatuses[(deviceType, status)]
+    except KeyError:
+        pass
+
+    decoded = []
+    for shift, mask, outcomes in _compiledStatusRules.get(deviceType, []):
+        outcome = outcomes.get((status >> shift) & mask)
+        if outcome:
+            decoded.append(outcome)
+
+    decoded = tuple(decoded)
+    _decodedStatuses[(deviceType, status)] = decoded
+
+    return decoded
+
+
+def worst_severity(severities):
+    '''
+    Returns the severity of severityCodes that decides the exit code of
+    the list severities, or None if none of them counts.
+
+    >>> worst_severity([None, 'warning', 'critical'])
+    'critical'
+    >>> print worst_severity([None])
+    None
+    '''
+    for severity, exitCode in severityCodes:
+        if severity in severities:
+            return severity
+
+    return None
+
+
+def format_perfdata(perfData):
+    '''
+    Returns a (label, value, unit, warn, crit, min, max) perfdata tuple in
+    the Nagios format, a float is given to the millisecond and empty
+    fields at the end are left out.
+
+    >>> format_perfdata(('Temp 1', 45, '', 70, 80, 0, 100))
+    "'Temp 1'=45;70;80;0;100"
+    >>> format_perfdata(('check_drive_status_time', 0.1, 's', '', '', 0, ''))
+    "'check_drive_status_time'=0.100s;;;0"
+    '''
+    label, value, unit = perfData[:3]
+    limits = ['%s' % (limit) for limit in perfData[3:]]
+
+    while limits and not limits[-1]:
+        limits.pop()
+
+    if isinstance(value, float):
+        value = '%.3f' % (value)
+
+    return ';'.join(["'%s'=%s%s" % (label, value, unit)] + limits)
+
+
+class CheckResult(object):
+    '''
+    The result of one run of the checks, what the plugin prints is
+    rendered from it and so is its JSON form.
+
+    host: a string, the agent checked
+    state: a dictionary of severity to the number of components in it
+    components: a list of dictionaries, one per line of output, holding
+    the component, the line, its severity, None if it is only
+    informational, and the raw status code behind it, if any
+    perfdata: a list of (label, value, unit, warn, crit, min, max) tuples
+    codes: a dictionary of the raw status codes and readings of the
+    drives, logical drives and luDev devices
+
+    >>> result = CheckResult('raid1', {'critical':1, 'warning':0,
+    ...     'unknown':0}, [{'component':'Drive 3', 'severity':'critical',
+    ...     'code':255, 'text':'Drive 3: Failed Drive'}],
+    ...     [('Temp 1', 45, '', 70, 80, 0, 100)], {})
+    >>> result.nagios()
+    (2, "CRITICAL: Drive 3: Failed Drive | 'Temp 1'=45;70;80;0;100 ")
+    '''
+
+    def __init__(self, host, state, components, perfdata, codes):
+
+        self.host = host
+        self.state = state
+        self.components = components
+        self.perfdata = perfdata
+        self.codes = codes
+
+        self.status, self.exit_code = 'OK', OK
+        for severity, exitCode in severityCodes:
+            if state[severity]:
+                self.status, self.exit_code = severity.upper(), exitCode
+                break
+
+    def nagios(self):
+        '''
+        Returns a tuple of the Nagios exit code and the line of output the
+        plugin prints.
+        '''
+        finalLine = ''.join([' %s ' % (component['text'])
+                             for component in self.components])
+
+        # Add in performance data if it exists
+        if self.perfdata:
+            finalLine += '| ' + ''.join([format_perfdata(perfData) + ' '
+                                         for perfData in self.perfdata])
+
+        return self.exit_code, '%s:%s' % (self.status, finalLine)
+
+    def as_dict(self):
+        '''
+        Returns the result as a dictionary that serializes to JSON.
+        '''
+        fields = ('label', 'value', 'unit', 'warn', 'crit', 'min', 'max')
+
+        return {'host':self.host,
+                'status':self.status,
+                'exit_code':self.exit_code,
+                'state':self.state,
+                'components':self.components,
+                'perfdata':[dict(zip(fields, perfData))
+                            for perfData in self.perfdata],
+                'codes':self.codes,
+                }
+
+
 class CheckInfortrend(Snmp):
     '''
     Main class that performs checks against the passed in RAID, this class
@@ -245,16 +2543,112 @@ class CheckInfortrend(Snmp):
     verbose: a integer, any number other than zero will give you verbose output
     version: a string specifying the SNMP version to use only 1, and 2c are
     supported
+    backend: a string, 'native' to use the in-process SNMP engine,
+    'subprocess' to run the net-snmp tools or 'replay' to answer from a
+    recorded session
+    workers: an integer, how many independent queries may run in parallel
+    cache_dir: a string, directory to keep state between runs in, None
+    disables the cache, so does a directory other users may write to,
+    see _private_directory
+    detect_ttl: an integer, seconds a detected base OID is trusted for
+    inventory_ttl: an integer, seconds the model and firmware details are
+    trusted for
+    trace_file: a string, file to write the query timings to as JSON after
+    each run, {host} is replaced by the agent
+    trace_perfdata: a boolean, add the time spent in each phase to the
+    perfdata
+    session: an SnmpSession to record to, or to replay from when the
+    backend is 'replay', the cache is not used with one
+    vectorize: a boolean, evaluate the luDev table with numpy array
+    operations, if it is installed, instead of a handler call per row
+    timeout: an integer, seconds a run may take, the parts not checked
+    by then are reported UNKNOWN, None to wait as long as the SNMP
+    timeouts allow
+    show_changes: a boolean, add the status changes since the previous
+    run to the output, needs cache_dir
+    history: a boolean, keep the readings of the temperature, fan and
+    voltage sensors in a SensorHistory under cache_dir
+    temp_rise: a tuple of the warning and critical rise in temperature,
+    in degrees Celsius, either may be None, over trend_window seconds,
+    keeps the history as well
+    trend_window: an integer, seconds the rise in temperature is
+    measured over
+    socket_pool: an integer, number of UDP sockets shared by every
+    CheckInfortrend of the process, 0 for a socket per request
     '''
 
+    # The phases of a run, in order, and how they are reported when the
+    # run ran out of time before finishing them
+    phases = ('auto_detect', 'check_model_firmware', 'check_drive_status',
+              'check_device_status')
+    phase_names = {'auto_detect':'Detection',
+                   'check_model_firmware':'Model and firmware',
+                   'check_drive_status':'Drive status',
+                   'check_device_status':'Device status',
+                   }
+
+    # Seconds a cached latency estimate of the agent is trusted for
+    latency_ttl = 3600
+
     def __init__(self, blacklist, community='public', agent='localhost',
-                 verbose=0, version='2c'):
+                 verbose=0, version='2c', backend='native', workers=1,
+                 cache_dir=None, detect_ttl=86400, inventory_ttl=86400,
+                 trace_file=None, trace_perfdata=False, session=None,
+                 vectorize=False, timeout=None, show_changes=False,
+                 history=False, temp_rise=None, trend_window=600,
+                 socket_pool=0):
 
         self.blacklist = self._parse_blacklist(blacklist)
 
         # Base OID found during auto detect
         self.base_oid = ''
 
+        # A session records, and replays, a run from a cold start so it
+        # never depends on what the cache held
+        if session is not None:
+            cache_dir = None
+
+        # State kept between runs, and whether base_oid came from it
+        self.cache = None
+        if cache_dir:
+            try:
+                _private_directory(cache_dir)
+                self.cache = StateCache(cache_dir, agent)
+            except OSError, error:
+                if verbose > 0:
+                    print 'Debug1: Cache disabled:', error
+                cache_dir = None
+        self.detect_ttl = detect_ttl
+        self.base_oid_cached = False
+        self.stale_base_oid = ''
+        self.detect_lock = threading.Lock()
+        self.inventory_ttl = inventory_ttl
+
+        # Serial number answered by the detection probe, if it ran
+        self.serial_number = None
+
+        # Scalars fetched during this run, OID: value, see _query_scalars
+        self.scalars = {}
+
+        # Wall time of each phase of the last run
+        self.trace_file = trace_file
+        self.trace_perfdata = trace_perfdata
+        self.phase_times = {}
+
+        self.vectorize = vectorize
+        self.timeout = timeout
+
+        # Status changes since the previous run, found with the cache
+        self.show_changes = show_changes
+        self.changes = []
+
+        # Sensor readings kept between runs, for the trend thresholds
+        self.history_dir = None
+        if cache_dir and (history or temp_rise):
+            self.history_dir = os.path.join(cache_dir, 'history')
+        self.temp_rise = temp_rise
+        self.trend_window = trend_window
+
         # Holder for state counts
         self.state = {'critical': 0, 'unknown': 0, 'warning': 0}
 
@@ -262,10 +2656,17 @@ class CheckInfortrend(Snmp):
         self.output = []
         self.perfData = []
 
+        # Raw codes and readings of the last run, for MetricsExporter
+        self.readings = {}
+
+        # Phases the last run did not finish within the timeout
+        self.timed_out = []
+
         # Initialize our superclass
-        Snmp.__init__(self, version, agent, community, verbose)
+        Snmp.__init__(self, version, agent, community, verbose, backend,
+                      workers, session, socket_pool)
 
-    def auto_detect(self):
+    def auto_detect(self, use_cache=True):
         '''
         Perform auto detection on designated SNMP agent in order
         to determine which base OID to use.
@@ -273,205 +2674,395 @@ class CheckInfortrend(Snmp):
         There can be more OIDs, and I am sure there are. Just add the base OID
         to the list and the agent can be detected.
 
-        This method expects no arguments.
+        A base OID detected within the last detect_ttl seconds is taken
+        from the cache without asking the agent, unless use_cache is
+        False.
         '''
 
+        # A long lived instance keeps what it found last time
+        if use_cache and self.base_oid and self.base_oid_cached:
+            return None
+
+        if use_cache and self.cache:
+            cachedOid = self.cache.get('base_oid', self.detect_ttl)
+
+            if cachedOid:
+                self.base_oid = str(cachedOid)
+                self.base_oid_cached = True
+
+                if self.verbose > 1:
+                    print 'Debug 2: Base OID from cache:', self.base_oid
+
+                return None
+
+        self.base_oid = ''
+        self.base_oid_cached = False
+        self.serial_number = None
+
         # Infortrend's base oid: 1.3.6.1.4.1.1714.
         # Sun's base oid for 3510: 1.3.6.1.4.1.42.2.180.3510.1.
         # Sun's base oid for 3511: 1.3.6.1.4.1.42.2.180.3511.1.
 
         baseoids = ['1.3.6.1.4.1.1714.', '1.3.6.1.4.1.1714.1.',
                     '1.3.6.1.4.1.42.2.180.3510.1.',
-                    '1.3.6.1.4.1.42.2.180.3510.1.',]
+                    '1.3.6.1.4.1.42.2.180.3511.1.',]
 
-        for baseoid in baseoids:
-            result = self.query('snmpget', baseoid + '1.1.1.10.0')
+        # Probe every candidate at once, the first one to answer wins
+        results = self.query_many([baseoid + '1.1.1.10.0'
+                                   for baseoid in baseoids])
 
-            if result != 'No Such Object available on this agent at this OID':
+        for baseoid, result in zip(baseoids, results):
+            if result not in (NO_SUCH_OBJECT, NO_SUCH_INSTANCE):
                 self.base_oid = baseoid
+                # The probe is the serial number, keep it for later checks
+                self.serial_number = result
+                self.scalars[baseoid + '1.1.1.10.0'] = result
                 break
 
         if not self.base_oid:
-            print ('Unable to auto detect array type at host: %s, '
-                   'exiting.') % (self.agent)
-            sys.exit(CRITICAL)
+            raise CheckError('Unable to auto detect array type at host: '
+                             '%s, exiting.' % (self.agent))
+
+        if self.cache:
+            self.cache.set('base_oid', self.base_oid)
 
         if self.verbose > 1:
             print 'Debug 2: Base OID set to:', self.base_oid
 
         return None
 
-    def check_all(self):
+    def check_all(self, output_format='text'):
         '''
         Convenience method that will run all of the checks against the
         RAID.
 
+        This method expects one argument:
+        output_format: a string, 'text' or 'json', see parse_print_exit
+        '''
+
+        try:
+            self.run_checks()
+        except CheckError, error:
+            if output_format == 'json':
+                statusNames = dict([(exitCode, severity.upper())
+                                    for severity, exitCode in severityCodes])
+                print json.dumps({'host':self.agent,
+                                  'status':statusNames.get(error.status, 'OK'),
+                                  'exit_code':error.status,
+                                  'error':str(error)}, sort_keys=True)
+            else:
+                print error
+            sys.exit(error.status)
+
+        self.parse_print_exit(output_format)
+
+        return None
+
+    def reset(self):
+        '''
+        Clear the results of the previous run so the same instance, with
+        its SNMP session and base OID, can check the RAID again. The base
+        OID is treated like a cached one, it is detected again should it
+        stop working.
+
         This method expects no arguments.
         '''
 
-        self.auto_detect()
-        self.check_model_firmware()
-        self.check_drive_status()
-        self.check_device_status()
-        self.parse_print_exit()
+        self.state = {'critical': 0, 'unknown': 0, 'warning': 0}
+        self.output = []
+        self.perfData = []
+        self.trace = []
+        self.phase_times = {}
+        self.changes = []
+        self.readings = {}
+        self.scalars = {}
+        self.timed_out = []
+
+        if self.base_oid:
+            self.base_oid_cached = True
 
         return None
 
-    def _check_battery(self, deviceDescription, status, sensorValue, sensorValueUnit):
+    def run_checks(self):
         '''
-        For internal use, checks the battery status. Expects a string for
-        the deviceDescription, an integer for the status and an integer for
-        the sensorValue.
+        Run all of the checks against the RAID without printing or
+        exiting, the results are left in self.state, self.output and
+        self.perfData. Raises CheckError if the checks can not be
+        completed.
+
+        Should the timeout pass, or the agent stop answering, what was
+        collected so far is kept and every phase left unfinished is
+        reported UNKNOWN.
+
+        This method expects no arguments.
+
+        >>> import infortrend_simulator
+        >>> simulator = infortrend_simulator.InfortrendSimulator(
+        ...     infortrend_simulator.synthetic_tree(), community='private')
+        >>> simulator.start()
+        >>> check = CheckInfortrend(None, timeout=10,
+        ...                         agent='127.0.0.1:%d' % simulator.port)
+        >>> check._get_engine().retries = 0
+        >>> check.run_checks()
+        >>> check.parse_results()[0]
+        3
+        >>> check.timed_out == list(check.phases)
+        True
+        >>> simulator.stop()
         '''
 
-        # If status is 0 everything is copacetic
-        if status != 0:
-            outputLine = []
+        self.deadline.start(self.timeout)
+        self._load_latency()
 
-            outputLine.append(deviceDescription + ':') # Begin our output line
+        try:
+            for position, phase in enumerate(self.phases):
+                self.phase = phase
+                startTime = time.time()
+                try:
+                    getattr(self, phase)()
+                except CheckError, error:
+                    if self.deadline.expired():
+                        self._report_timed_out(self.phases[position:])
+                        break
+
+                    # The engine gave up on the agent before the deadline
+                    if not isinstance(error, CheckTimeout):
+                        raise
+
+                    self._report_timed_out(self.phases[position:],
+                                           'the agent stopped answering')
+                    break
+                finally:
+                    self.phase_times[phase] = time.time() - startTime
+        finally:
+            self.phase = None
+            self._save_latency()
+
+            if self.cache:
+                self.cache.flush()
+
+            if self.trace_file:
+                self.write_trace(self.trace_file.replace('{host}',
+                                                         self.agent))
+
+        if self.show_changes and self.changes:
+            self._add_output('Changes since last poll: ' +
+                             ', '.join(self.changes), 'Changes')
+
+        if self.trace_perfdata:
+            summary = self.trace_summary()
+
+            for phase in self.phases:
+                totals = summary.get(phase, {'requests':0, 'spawns':0})
+                self._add_perfdata(phase + '_time',
+                                   self.phase_times.get(phase, 0.0),
+                                   minimum=0, unit='s')
+                self._add_perfdata(phase + '_round_trips',
+                                   totals['requests'] + totals['spawns'],
+                                   minimum=0)
 
-            binary = self._convertIntegerToBinaryAndFormat(status)
+        return None
 
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
+    def _previous_rows(self, section):
+        '''
+        For internal use, returns the rows _evaluate_rows kept for section
+        on the previous run, a dictionary of row key to a list of its
+        signature, label, status, output lines, perfdata and state counts.
+        Empty without a cache or if the blacklist has changed since.
+        '''
+        if not self.cache:
+            return {}
 
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Battery is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        stored = self.cache.get('evaluation_' + section, self.inventory_ttl)
 
-            try:
-                if binary[-2] == '1':
-                    outputLine.append('Battery charging on')
-            except IndexError:
-                pass
+        if not stored or stored['blacklist'] != self.blacklist:
+            return {}
 
-            try:
-                numeral = self._convertBinarytoInteger(binary[-4:-2])
+        return stored['rows']
+
+    def _evaluate_rows(self, section, previous, rows, evaluate):
+        '''
+        For internal use, calls evaluate(*arguments) for every (key, label,
+        status, signature, arguments) tuple in the list rows, in order.
+
+        A row whose signature, a list of everything evaluate looks at, is
+        the same as in previous, see _previous_rows, and that was
+        evaluated with the same evaluationVersion, has the output,
+        perfdata and state counts it gave then added again instead. Only
+        rows that changed are decoded, and only they cost follow-up
+        queries. Status changes are added to self.changes.
+        '''
+        current = {}
+
+        for key, label, status, signature, arguments in rows:
+            old = previous.get(key)
+            signature = [evaluationVersion] + signature
+
+            if old and old[0] == signature:
+                lines, perfData, counts = old[3:]
+                self.output.extend(lines)
+                self.perfData.extend(perfData)
+                for severity, count in counts.items():
+                    self.state[severity] += count
+            else:
+                outputStart = len(self.output)
+                perfDataStart = len(self.perfData)
+                stateBefore = dict(self.state)
 
-                if numeral == 1:
-                    outputLine.append('Battery not fully charged')
-                elif numeral == 2:
-                    outputLine.append('Battery charge critically low')
-                    self.state['critical'] += 1
-                elif numeral == 3:
-                    outputLine.append('Battery completely drained')
-                    self.state['critical'] += 1
+                evaluate(*arguments)
 
-            except IndexError:
-                pass
+                lines = self.output[outputStart:]
+                perfData = self.perfData[perfDataStart:]
+                counts = dict([(severity, self.state[severity] -
+                                stateBefore[severity])
+                               for severity in self.state
+                               if self.state[severity] !=
+                               stateBefore[severity]])
 
-            try:
-                if binary[-7] == '1':
-                    # This is a normal state on cheaper RAIDs thus no warning
-                    outputLine.append('Battery-backup is disabled')
-            except IndexError:
-                pass
+            current[key] = [signature, label, status, lines, perfData,
+                            counts]
 
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Battery is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+            if previous and not old:
+                self.changes.append('%s: new' % (label))
+            elif old and old[2] != status:
+                self.changes.append('%s: %s -> %s' % (label, old[2], status))
+
+        for key in sorted(set(previous) - set(current), key=_oid_tuple):
+            self.changes.append('%s: removed' % (previous[key][1]))
 
-            self.output.append(' '.join(outputLine))
+        if self.cache:
+            self.cache.set('evaluation_' + section,
+                           {'blacklist':self.blacklist, 'rows':current})
 
         return None
 
-    def _check_cache_data_backup_flash_device(self, deviceDescription, status, sensorValue, sensorValueUnit):
+    def _add_output(self, text, component, severity=None, code=None):
         '''
-          Cache-Data-Backup Flash Device:
-             BIT 0 - CLEAR:  Flash Device functioning normally.
-                     SET:    Flash Device malfunctioning.
-             BITS 1-5 - Reserved (Set to 0).
-             BIT 6 - CLEAR:  Flash Device is enabled.
-                     SET:    Flash Device is disabled.
-             BIT 7 - CLEAR:  Flash Device IS present.
-                     SET:    Flash Device is NOT present.
-             == 0xff - Status unknown.
+        For internal use, adds a line of output about component, see
+        CheckResult. The state counters are left to the caller.
         '''
-        # If status is 0 everything is copacetic
-        if status != 0:
-            outputLine = []
+        self.output.append({'component':component, 'severity':severity,
+                            'code':code, 'text':text})
 
-            outputLine.append(deviceDescription + ':') # Begin our output line
+        return None
 
-            binary = self._convertIntegerToBinaryAndFormat(status)
+    def _add_perfdata(self, label, value, warn='', crit='', minimum='',
+                      maximum='', unit=''):
+        '''
+        For internal use, adds a perfdata tuple, see format_perfdata.
+        '''
+        self.perfData.append((label, value, unit, warn, crit, minimum,
+                              maximum))
 
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Flash Device malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        return None
+
+    def _report_timed_out(self, phases, reason=None):
+        '''
+        For internal use, marks every phase in the list phases as not
+        checked within the timeout, or for the string reason if given.
+        '''
+        self.timed_out = list(phases)
+
+        if reason is None:
+            reason = 'not checked within %ss' % (self.timeout)
 
-            self.output.append(' '.join(outputLine))
+        for phase in phases:
+            self._add_output('%s: UNKNOWN, %s'
+                             % (self.phase_names[phase], reason),
+                             self.phase_names[phase], 'unknown')
+            self.state['unknown'] += 1
 
         return None
 
+    def _load_latency(self):
+        '''
+        For internal use, starts the engine from the latency of the agent
+        seen by earlier runs, so the first queries already wait no longer
+        than they need to.
+        '''
+        if not self.cache or self._uses_subprocess():
+            return None
 
-    def _check_current_sensor(self, deviceDescription, status, sensorValue, sensorValueUnit):
+        latency = self.cache.get('latency', self.latency_ttl)
+        engine = self._get_engine()
+
+        if latency and engine.get_latency()[0] is None:
+            engine.set_latency(*latency)
+
+        return None
+
+    def _save_latency(self):
         '''
-        For internal use, checks the current sensor status. Expects a
-        string for the deviceDescription, an integer for the status and
-        an integer for the sensorValue.
+        For internal use, keeps the latency estimate for the next run.
         '''
+        if not self.cache or self._engine is None:
+            return None
 
-        if status != 0:
-            outputLine = []
+        latency = self._engine.get_latency()
+        if latency[0] is not None:
+            self.cache.set('latency', list(latency))
+
+        return None
 
-            outputLine.append(deviceDescription + ':') # Begin our output line
+    def write_trace(self, file_path):
+        '''
+        Write the timing of the last run as JSON to file_path: the wall
+        time of every phase, the query totals of every phase and every
+        query made. Failing to write the trace is not fatal.
+        '''
 
-            binary = self._convertIntegerToBinaryAndFormat(status)
+        trace = {'agent':self.agent,
+                 'backend':self.backend,
+                 'phase_times':self.phase_times,
+                 'phases':self.trace_summary(),
+                 'queries':self.trace,
+                 }
 
+        try:
+            traceFile = open(file_path, 'w')
+            try:
+                json.dump(trace, traceFile, indent=1, sort_keys=True)
+            finally:
+                traceFile.close()
+        except IOError, error:
             if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
+                print 'Debug1: Unable to write trace:', error
 
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Current sensor malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        return None
 
-            try:
-                numeral = self._convertBinarytoInteger(binary[-4:-1])
+    def _check_battery(self, deviceDescription, status, sensorValue, sensorValueUnit):
+        '''
+        For internal use, checks the battery status. Expects a string for
+        the deviceDescription, an integer for the status and an integer for
+        the sensorValue.
+        '''
+        self._report_status(11, deviceDescription, status, sensorValue)
 
-                if numeral == 3:
-                    outputLine.append('Over current warning')
-                    self.state['warning'] += 1
-                elif numeral == 5:
-                    outputLine.append('Over current limit exceeded')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        return None
 
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Current sensor is not activated')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
+    def _check_cache_data_backup_flash_device(self, deviceDescription, status, sensorValue, sensorValueUnit):
+        '''
+          Cache-Data-Backup Flash Device:
+             BIT 0 - CLEAR:  Flash Device functioning normally.
+                     SET:    Flash Device malfunctioning.
+             BITS 1-5 - Reserved (Set to 0).
+             BIT 6 - CLEAR:  Flash Device is enabled.
+                     SET:    Flash Device is disabled.
+             BIT 7 - CLEAR:  Flash Device IS present.
+                     SET:    Flash Device is NOT present.
+             == 0xff - Status unknown.
+        '''
+        self._report_status(13, deviceDescription, status, sensorValue)
 
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Current sensor not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        return None
 
-            self.output.append(' '.join(outputLine))
+    def _check_current_sensor(self, deviceDescription, status, sensorValue, sensorValueUnit):
+        '''
+        For internal use, checks the current sensor status. Expects a
+        string for the deviceDescription, an integer for the status and
+        an integer for the sensorValue.
+        '''
+        self._report_status(6, deviceDescription, status, sensorValue)
 
         return None
 
@@ -481,53 +3072,10 @@ class CheckInfortrend(Snmp):
         string for the deviceDescription, an integer for the status and
         an integer for the sensorValue.
         '''
-
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') # Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Door, door lock, or door sensor '
-                                      'malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-2] == '1':
-                    outputLine.append('Door is open')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Door lock not engaged')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Door is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(9, deviceDescription, status, sensorValue)
 
         return None
 
-
     def _check_fan(self, deviceDescription, status, sensorValue, sensorValueUnit):
         '''
         For internal use, checks the fan status. Expects a string
@@ -563,46 +3111,8 @@ class CheckInfortrend(Snmp):
             b). Not accurate, but serves to have homogeneus values.
         '''
 
-        #Infortrend decided to do mappings from certain numbers to fan speeds
-        #Why they couldn't just output the speed is beyond me, but I don't do
-        #hardware design so maybe there is a good reason.
-        fanSpeedsOld = {0:0,           #Indicates fan speed is not available.
-                     12292:4000,
-                     77828:4285,
-                     143364:4570,
-                     208900:4571,
-                     274436:4857,
-                     339972:5428,
-                     405508:5713,
-                     471044:5800,
-                     }
-        fanSpeedsNew = {1:4000,
-                     2:4285,
-                     3:4570,
-                     0:4571,
-                     4:4857,
-                     5:5428,
-                     6:5713,
-                     7:5800,
-                     }
         # Printing fan speed
-
-        #Sometimes the value is ludicrously large
-        if sensorValue > 0xffff:
-            sensorValue &= 0x0000ffff
-
-        # If value higher to max rpm, then user fanSpeedsOld table
-        if sensorValue > 10000:
-            fanSpeed = fanSpeedsOld[sensorValue]
-        elif sensorValueUnit == 0 or sensorValueUnit == -1:
-            # Speed according to fanSpeedsNew table
-            fanSpeed = fanSpeedsNew[sensorValue]
-        elif sensorValueUnit == 1:
-            # Speed should be in sensorValue
-            fanSpeed = sensorValue
-        else:
-            # Never should reach this code....
-            fanSpeed=0
+        fanSpeed = self._fan_speed(sensorValue, sensorValueUnit)
 
         warnRPM = '5713'
         critRPM = '5800'
@@ -612,57 +3122,48 @@ class CheckInfortrend(Snmp):
         if self.verbose > 0:
             print 'Debug1: Fan speed is:%s rpm.'% (fanSpeed)
 
-        self.perfData.append("'%s'=%s;%s;%s;%s;%s"
-                             % (deviceDescription,
-                                fanSpeed, warnRPM,
-                                critRPM, minRPM, maxRPM))
-
-        outputLine = []
-        outputLine.append(deviceDescription + ':') #Begin our output line
-
-        if status != 0:
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Fan is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Fan is off')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Fan is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        self._add_perfdata(deviceDescription, fanSpeed, int(warnRPM),
+                           int(critRPM), int(minRPM), int(maxRPM))
 
-            self.output.append(' '.join(outputLine))
+        outputLine = self._report_status(2, deviceDescription, status,
+                                         sensorValue)
 
         # If fan speed is high, raise a warning or critical
         if fanSpeed >= critRPM:
             outputLine.append('Fan speed is >= ' + str(critRPM))
             self.state['critical'] += 1
-            self.output.append(' '.join(outputLine))
+            self._add_output(' '.join(outputLine), deviceDescription,
+                             'critical', status)
         elif fanSpeed >= warnRPM:
             outputLine.append('Fan speed is >= ' + str(warnRPM))
             self.state['warning'] += 1
-            self.output.append(' '.join(outputLine))
+            self._add_output(' '.join(outputLine), deviceDescription,
+                             'warning', status)
 
         return None
 
+    def _fan_speed(self, sensorValue, sensorValueUnit):
+        '''
+        For internal use, returns the speed in rpm a fan reports, see
+        _check_fan.
+        '''
+        #Sometimes the value is ludicrously large
+        if sensorValue > 0xffff:
+            sensorValue &= 0x0000ffff
+
+        # If value higher to max rpm, then user fanSpeedsOld table
+        if sensorValue > 10000:
+            return fanSpeedsOld[sensorValue]
+        elif sensorValueUnit == 0 or sensorValueUnit == -1:
+            # Speed according to fanSpeedsNew table
+            return fanSpeedsNew[sensorValue]
+        elif sensorValueUnit == 1:
+            # Speed should be in sensorValue
+            return sensorValue
+
+        # Never should reach this code....
+        return 0
+
     def _check_generic_device(self, deviceDescription, status, sensorValue, sensorValueUnit):
         '''
             Check used for generic devices where we just want an OK/KO
@@ -672,53 +3173,82 @@ class CheckInfortrend(Snmp):
              - Midplane / backplane
              - Enclosure Drawer
         '''
+        self._report_status(14, deviceDescription, status, sensorValue)
 
-        # If status is 0 everything is copacetic
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') # Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
+        return None
 
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-            try:
-                if binary[-1] == '1':
-                    outputLine.append(deviceDescription + ' malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+    def _check_hdd_model_serial_number(self, hdd, details):
+        '''
+        For internal use, appends the model and serial number for the
+        drive number that is passed in to the nagios output.
+        This is designed to be used when a failed drive is detected,
+        the model and serial number is grabbed for convenience.
+        It can however, be used for other purposes. Takes two arguments,
+        hdd which is an int of the drive you wish to check and details,
+        the dictionary returned by _get_hdd_model_serial_numbers.
+        '''
 
-            self.output.append(' '.join(outputLine))
+        model, serialNumber = details[hdd]
+        self._add_output('model:%s' % (model), 'Drive %d' % (hdd))
+        self._add_output('serial number:%s' % (serialNumber),
+                         'Drive %d' % (hdd))
 
         return None
 
-
-    def _check_hdd_model_serial_number(self, hdd):
+    def _get_hdd_model_serial_numbers(self, hdds, drives):
         '''
-        For internal use, grabs the model and serial number for the d
-        rive number that is passed in and appends it to the nagios output.
-        This is designed to be used when a failed drive is detected,
-        the model and serial number is grabbed for convenience.
-        It can however, be used for other purposes. Takes one argument hdd
-        which is an int of the drive you wish to check.
+        For internal use, returns a dictionary of drive number to a
+        (model, serial number) tuple for every drive in the list drives.
+        Requires the list of hddStatus values as well.
+
+        Drives found in the cache are not asked for, the rest are fetched
+        together in one multi-varbind GET. While the cache is older than
+        inventory_ttl the whole model and serial number table is fetched
+        again and kept for every healthy drive, so the details are still
+        known once a drive has failed or disappeared.
         '''
-        hddModel = ('Hard Drive Model:',
-                    self.base_oid + '1.6.1.15.' + str(hdd), 'snmpget')
-        hddSerialNum = ('Hard Drive Serial Number:',
-                        self.base_oid + '1.6.1.17.' + str(hdd),
-                        'snmpget')
 
-        model = self._query(hddModel)[1]
-        self.output.append('model:%s' % (model))
-        serialNumber = self._query(hddSerialNum)[1]
-        self.output.append('serial number:%s' % (serialNumber))
+        details = {}
 
+        if self.cache:
+            cached = self.cache.get('drive_details') or {}
+            age = self.cache.age('drive_details')
 
-        return None
+            if age is None or age > self.inventory_ttl:
+                rows = self._query_table([
+                    ('Hard Drive Model:', self.base_oid + '1.6.1.15',
+                     'snmpwalk'),
+                    ('Hard Drive Serial Number:', self.base_oid + '1.6.1.17',
+                     'snmpwalk')])
+
+                for drive, status in enumerate(hdds):
+                    row = rows.get(str(drive + 1))
+
+                    if (row and status not in (63, 252, 253, 254, 255) and
+                        not set(row) & set([None, NO_SUCH_OBJECT,
+                                            NO_SUCH_INSTANCE])):
+                        cached[str(drive + 1)] = row
+
+                self.cache.set('drive_details', cached)
+
+            for drive in drives:
+                if str(drive) in cached:
+                    details[drive] = tuple(cached[str(drive)])
+
+        missing = [drive for drive in drives if drive not in details]
+
+        if missing:
+            oids = []
+            for drive in missing:
+                oids.append(self.base_oid + '1.6.1.15.' + str(drive))
+                oids.append(self.base_oid + '1.6.1.17.' + str(drive))
+
+            values = self.query_many(oids)
+
+            for position, drive in enumerate(missing):
+                details[drive] = tuple(values[position * 2:position * 2 + 2])
+
+        return details
 
     def _check_hdd_status(self, hdds):
         '''
@@ -751,27 +3281,51 @@ class CheckInfortrend(Snmp):
                          255:'Failed Drive'
                          }
 
-        for drive, status in enumerate(hdds):
+        previous = self._previous_rows('hdd')
+        rows = [(str(drive + 1), 'Drive %d' % (drive + 1), status, [status],
+                 (drive, status)) for drive, status in enumerate(hdds)]
+
+        # Failed and absent drives get their model and serial number shown,
+        # only asked for when they have just failed
+        failedDrives = [drive + 1 for drive, status in enumerate(hdds)
+                        if (status == 255 or (status == 63 and
+                        not self.blacklist.count('absent_drives'))) and
+                        previous.get(str(drive + 1), [None])[0] !=
+                        [evaluationVersion, status]]
+        details = {}
+
+        # With a cache this also keeps the details of healthy drives fresh
+        if failedDrives or self.cache:
+            details = self._get_hdd_model_serial_numbers(hdds, failedDrives)
+
+        def check_drive(drive, status):
+            '''
+            Checks the status of one drive, numbered from 0.
+            '''
             if self.verbose > 0:
                 print 'Debug1: checking drive:', drive, 'with status:', status
 
             # Drive Absent is something blacklistable. Check it
             if status == 63 and self.blacklist.count('absent_drives'):
-                continue
+                return
 
             if status in criticalCodes:
                 self.state['critical'] += 1
-                self.output.append('Drive ' + str(drive + 1) + ': '
-                                + criticalCodes[status])
+                self._add_output('Drive ' + str(drive + 1) + ': '
+                                 + criticalCodes[status],
+                                 'Drive %d' % (drive + 1), 'critical', status)
 
                 # Grab the serial if the drive has failed, for lazy admins
                 if status == 255 or status == 63:
-                    self._check_hdd_model_serial_number(drive + 1)
+                    self._check_hdd_model_serial_number(drive + 1, details)
 
             elif status in warningCodes:
                 self.state['warning'] += 1
-                self.output.append('Drive ' + str(drive + 1) + ': '
-                                + warningCodes[status])
+                self._add_output('Drive ' + str(drive + 1) + ': '
+                                 + warningCodes[status],
+                                 'Drive %d' % (drive + 1), 'warning', status)
+
+        self._evaluate_rows('hdd', previous, rows, check_drive)
 
         return None
 
@@ -794,20 +3348,33 @@ class CheckInfortrend(Snmp):
                          128:'Logical Drive Off-line'
                          }
 
-        for drive, status in enumerate(logicalDrives):
+        def check_logical_drive(drive, status):
+            '''
+            Checks the status of one logical drive, numbered from 0.
+            '''
             if self.verbose > 0:
                 print ('Debug1: Checking logical drive: '
                        '%s with status: %s') % (drive, status)
 
             if status in criticalCodes:
                 self.state['critical'] += 1
-                self.output.append('Logical Drive ' + str(drive + 1) + ': '
-                            + criticalCodes[int(status)])
+                self._add_output('Logical Drive ' + str(drive + 1) + ': '
+                                 + criticalCodes[int(status)],
+                                 'Logical Drive %d' % (drive + 1), 'critical',
+                                 status)
 
             elif int(status) in warningCodes:
                 self.state['warning'] += 1
-                self.output.append('Logical Drive ' + str(drive + 1) + ': '
-                                + warningCodes[int(status)])
+                self._add_output('Logical Drive ' + str(drive + 1) + ': '
+                                 + warningCodes[int(status)],
+                                 'Logical Drive %d' % (drive + 1), 'warning',
+                                 status)
+
+        self._evaluate_rows('ld', self._previous_rows('ld'),
+                            [(str(drive + 1), 'Logical Drive %d' % (drive + 1),
+                              status, [status], (drive, status))
+                             for drive, status in enumerate(logicalDrives)],
+                            check_logical_drive)
 
         return None
 
@@ -823,30 +3390,10 @@ class CheckInfortrend(Snmp):
                              SET:    LED is NOT present.
                      == 0xff - Status unknown.
         '''
-
-        # If status is 0 everything is copacetic
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') # Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('ON')
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(12, deviceDescription, status, sensorValue)
 
         return None
 
-
     def _check_null(self, deviceDescription, status, sensorValue, sensorValueUnit):
         '''
         This is the dumping ground for unknown hardware entries. This sadly
@@ -862,41 +3409,7 @@ class CheckInfortrend(Snmp):
         for the deviceDescription, an integer for the status and an
         integer for the sensorValue.
         '''
-
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') #Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Power supply is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Power supply is off')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Power supply is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(1, deviceDescription, status, sensorValue)
 
         return None
 
@@ -906,41 +3419,7 @@ class CheckInfortrend(Snmp):
         string for the deviceDescription, an integer for the status and
         an integer for the sensorValue.
         '''
-
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') # Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Speaker is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Speaker is off')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Speaker is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(10, deviceDescription, status, sensorValue)
 
         return None
 
@@ -950,55 +3429,7 @@ class CheckInfortrend(Snmp):
         string for the deviceDescription, an integer for the status and
         an integer for the sensorValue.
         '''
-
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') # Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Slot sense circuitry is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-2] == '1':
-                    outputLine.append('Device in slot has been marked bad '
-                                      'and is awaiting a replacement')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-3] == '1':
-                    outputLine.append('Slot is not activated')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Slot is ready for insertion/removal')
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Slot is empty')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(17, deviceDescription, status, sensorValue)
 
         return None
 
@@ -1012,82 +3443,35 @@ class CheckInfortrend(Snmp):
             Temperature Sensor: the readable value = (luDevValue * luDevValueUnit / 1000) - 273
         but... some old devices doesnt follow de rule. I've made a guess shifting the value 16 bits right.
         '''
-        #Sometimes the value is ludicrously large
-        if sensorValue > 0xffff:
-            sensorValue >>= 16
-
-        #Some devices report a temperature of 0
-        if sensorValue == 0:
-            temperature = sensorValue
-        else:
-            # Temperature is in Celsius
-            temperature = (sensorValue * sensorValueUnit / 1000) - 273
+        temperature = self._temperature(sensorValue, sensorValueUnit)
 
         warnTemp = '70'
         critTemp = '80'
         minTemp = '0'
         maxTemp = '100'
 
-        self.perfData.append("'%s'=%s;%s;%s;%s;%s"
-                             % (deviceDescription, temperature, warnTemp,
-                                     critTemp, minTemp, maxTemp))
-
-        # If status is 0 everything is copacetic
-        if status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') #Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Temperature sensor is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        self._add_perfdata(deviceDescription, temperature, int(warnTemp),
+                           int(critTemp), int(minTemp), int(maxTemp))
 
-            try:
-                numeral = self._convertBinarytoInteger(binary[-4:-1])
-
-                if numeral == 2:
-                    outputLine.append('Cold temperature warning')
-                    self.state['warning'] += 1
-                elif numeral == 3:
-                    outputLine.append('Hot temperature warning')
-                    self.state['warning'] += 1
-                elif numeral == 4:
-                    outputLine.append('Cold temperature limit exceeded')
-                    self.state['critical'] += 1
-                elif numeral == 5:
-                    outputLine.append('Hot temperature limit exceeded')
-                    self.state['critical'] += 1
-
-            except IndexError:
-                pass
+        self._report_status(3, deviceDescription, status, sensorValue)
 
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Temperature sensor is not activated')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
+        return None
 
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Temperature sensor is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+    def _temperature(self, sensorValue, sensorValueUnit):
+        '''
+        For internal use, returns the temperature in Celsius a temperature
+        sensor reports, see _check_temp_sensor.
+        '''
+        #Sometimes the value is ludicrously large
+        if sensorValue > 0xffff:
+            sensorValue >>= 16
 
-            self.output.append(' '.join(outputLine))
+        #Some devices report a temperature of 0
+        if sensorValue == 0:
+            return sensorValue
 
-        return None
+        # Temperature is in Celsius
+        return (sensorValue * sensorValueUnit / 1000) - 273
 
     def _check_ups(self, deviceDescription, status, sensorValue, sensorValueUnit):
         '''
@@ -1099,63 +3483,7 @@ class CheckInfortrend(Snmp):
         if status == 255:
             return None
 
-        elif status != 0:
-            outputLine = []
-
-            outputLine.append(deviceDescription + ':') #Begin our output line
-
-            binary = self._convertIntegerToBinaryAndFormat(status)
-
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s '
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
-
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Unit is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-2] == '1':
-                    outputLine.append('AC Power not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            try:
-                numeral = self._convertBinarytoInteger(binary[-4:-2])
-
-                if numeral == 1:
-                    outputLine.append('Battery not fully charged')
-                    self.state['warning'] += 1
-                elif numeral == 2:
-                    outputLine.append('Battery charge critically low')
-                    self.state['critical'] += 1
-                elif numeral == 3:
-                    outputLine.append('Battery completely drained')
-                    self.state['critical'] += 1
-
-            except IndexError:
-                pass
-
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('UPS is off')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
-
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('UPS is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
-
-            self.output.append(' '.join(outputLine))
+        self._report_status(4, deviceDescription, status, sensorValue)
 
         return None
 
@@ -1165,60 +3493,72 @@ class CheckInfortrend(Snmp):
         the deviceDescription, an integer for the status and an integer for
         the sensorValue.
         '''
-        if status != 0:
-            outputLine = []
+        self._report_status(5, deviceDescription, status, sensorValue)
 
-            outputLine.append(deviceDescription + ':') # Begin our output line
+        return None
 
-            binary = self._convertIntegerToBinaryAndFormat(status)
+    def _voltage(self, sensorValue, sensorValueUnit):
+        '''
+        For internal use, returns the volts a voltage sensor reports, the
+        MIB's luDevValue * luDevValueUnit / 1000 is in millivolts.
+        '''
+        return sensorValue * sensorValueUnit / 1000.0 / 1000
 
-            if self.verbose > 0:
-                print ('Debug1: Device:%s, Value:%s, Status code:%s'
-                       'binary:%s') % (deviceDescription, sensorValue,
-                                            status, binary)
+    def _record_history(self, indexes, devices):
+        '''
+        For internal use, appends the reading of every temperature, fan
+        and voltage sensor in the list of luDev rows devices, with the
+        list of their indexes, to its history. Then checks the rise in
+        temperature over trend_window against temp_rise.
+        '''
+        readings = {2:self._fan_speed,
+                    3:self._temperature,
+                    5:self._voltage,
+                    8:self._temperature,
+                    }
+        now = time.time()
 
-            try:
-                if binary[-1] == '1':
-                    outputLine.append('Voltage sensor is malfunctioning')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        for index, (description, device, value, valueUnit, status) in \
+            zip(indexes, devices):
+            if device not in readings or value is None or valueUnit is None:
+                continue
 
+            history = SensorHistory(self.history_dir, self.agent,
+                                    '%s %s' % (index, description))
             try:
-                numeral = self._convertBinarytoInteger(binary[-4:-1])
+                history.append(now, readings[device](value, valueUnit))
 
-                if numeral == 2:
-                    outputLine.append('Low voltage warning')
-                    self.state['warning'] += 1
-                elif numeral == 3:
-                    outputLine.append('High voltage warning')
-                    self.state['warning'] += 1
-                elif numeral == 4:
-                    outputLine.append('Low voltage limit exceeded')
-                    self.state['critical'] += 1
-                elif numeral == 5:
-                    outputLine.append('High voltage limit exceeded')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+                if device in (3, 8) and self.temp_rise:
+                    self._check_temp_rise(description, history.values(
+                        now - self.trend_window))
+            finally:
+                history.close()
 
+        return None
 
+    def _check_temp_rise(self, deviceDescription, records):
+        '''
+        For internal use, compares how far the temperature has risen in
+        the list of (timestamp, temperature) records, from the lowest to
+        the latest, with temp_rise.
+        '''
+        if len(records) < 2:
+            return None
 
-            try:
-                if binary[-7] == '1':
-                    outputLine.append('Voltage sensor is not activated')
-                    self.state['warning'] += 1
-            except IndexError:
-                pass
+        rise = records[-1][1] - min([value for timestamp, value in records])
+        warnRise, critRise = self.temp_rise
 
-            try:
-                if binary[-8] == '1':
-                    outputLine.append('Voltage sensor is not present')
-                    self.state['critical'] += 1
-            except IndexError:
-                pass
+        if critRise is not None and rise > critRise:
+            severity = 'critical'
+        elif warnRise is not None and rise > warnRise:
+            severity = 'warning'
+        else:
+            return None
 
-            self.output.append(' '.join(outputLine))
+        self.state[severity] += 1
+        self._add_output('%s: Temperature rose %gC in %ss'
+                         % (deviceDescription, rise, self.trend_window),
+                         deviceDescription, severity)
 
         return None
 
@@ -1266,23 +3606,219 @@ class CheckInfortrend(Snmp):
         luDevStatus = ('Logical unit device status:',
                        self.base_oid + '1.9.1.13', 'snmpwalk')
 
-        deviceDescription = self._query(luDevDescription)[1]
-        deviceType = self._query(luDevType)[1]
-        deviceValue = self._query(luDevValue)[1]
-        deviceValueUnit = self._query(luDevValueUnit)[1]
-        deviceStatus = self._query(luDevStatus)[1]
+        # The columns every row needs are fetched together, one row per
+        # device
+        rows = self._query_table([luDevDescription, luDevType, luDevStatus])
+
+        devices = []
+        indexes = []
+
+        for index in sorted(rows, key=_oid_tuple):
+            description, device, status = rows[index]
+            value = valueUnit = None
+
+            if device is None:
+                if self.verbose > 0:
+                    print 'Debug1: Incomplete row skipped ->', index
+                continue
 
-        for number, device in enumerate(deviceType):
             if  not self.blacklist.count(blacklistoptions[device]):
-                luDevTypeCodes[device](deviceDescription[number],
-                                        deviceStatus[number],
-                                        deviceValue[number],
-                                        deviceValueUnit[number])
+                devices.append((description, device, value, valueUnit,
+                                status))
+                indexes.append(index)
             else:
                 if self.verbose > 0:
                     print 'Debug1: Device blacklisted ->', blacklistoptions[device]
+
+        # Only sensors use their value and unit, those are asked for with
+        # a multi-varbind GET of just the rows left after the blacklist
+        sensors = [position for position, row in enumerate(devices)
+                   if row[1] in luDevValueTypes]
+
+        if sensors:
+            oids = []
+            for position in sensors:
+                oids.append(luDevValue[1] + '.' + indexes[position])
+                oids.append(luDevValueUnit[1] + '.' + indexes[position])
+
+            # Walking both columns spawns two snmpwalks, fewer than the
+            # snmpgets this many OIDs need
+            if (self._uses_subprocess() and
+                len(oids) > SnmpEngine.max_varbinds):
+                table = self.query_table([luDevValue[1], luDevValueUnit[1]])
+                values = []
+                for position in sensors:
+                    values.extend(table.get(indexes[position], [None, None]))
+            else:
+                values = self.query_many(oids)
+
+            values = [None if value in (NO_SUCH_OBJECT, NO_SUCH_INSTANCE)
+                      else value for value in values]
+
+            for number, position in enumerate(sensors):
+                description, device, value, valueUnit, status = \
+                    devices[position]
+                devices[position] = (description, device, values[number * 2],
+                                     values[number * 2 + 1], status)
+
+        self.readings['devices'] = zip(indexes, devices)
+
+        # The handlers print the debugging output so verbose runs always
+        # use them
+        if self.vectorize and not self.verbose:
+            numpy = _import_numpy()
+
+            if numpy and self._check_devices_vectorized(devices, numpy):
+                if self.history_dir:
+                    self._record_history(indexes, devices)
+
+                return None
+
+        def check_device(description, device, value, valueUnit, status):
+            '''
+            Checks one luDev row with the handler for its type. A fan or
+            temperature sensor whose value could not be read is reported
+            UNKNOWN, the handlers need the value.
+            '''
+            if device in (2, 3, 8) and None in (value, valueUnit):
+                self._report_status(device, description, status, value)
+                self.state['unknown'] += 1
+                self._add_output('%s: Value not available' % (description),
+                                 description, 'unknown', status)
+                return
+
+            luDevTypeCodes[device](description, status, value, valueUnit)
+
+        self._evaluate_rows('devices', self._previous_rows('devices'),
+                            [(index, row[0], row[4], list(row), row)
+                             for index, row in zip(indexes, devices)],
+                            check_device)
+
+        if self.history_dir:
+            self._record_history(indexes, devices)
+
         return None
 
+    def _check_devices_vectorized(self, devices, numpy):
+        '''
+        For internal use, evaluates a list of (description, type, value,
+        value unit, status) luDev rows with array operations of the numpy
+        module passed in, instead of a handler call per row. Gives the same
+        output, perfdata and state counts, in the same order, as the
+        handlers in luDevTypeCodes.
+
+        Returns False, having changed nothing, if the rows hold anything
+        the handlers would treat specially: a value that is not an
+        integer, an unknown device type or a fan value missing from the
+        speed tables.
+        '''
+
+        # Only sensors have their value and unit fetched, the handlers of
+        # the rest never look at them
+        devices = [row if row[1] in luDevValueTypes else
+                   (row[0], row[1], 0, 0, row[4]) for row in devices]
+
+        # numpy only picks an integer dtype if every value is an integer
+        # that fits in one
+        columns = numpy.array(zip(*devices)[1:])
+        if columns.dtype.kind != 'i':
+            return False
+
+        types, values, units, statuses = columns.astype(numpy.int64)
+
+        if not set(numpy.unique(types).tolist()) <= set(blacklistoptions):
+            return False
+
+        readings = numpy.zeros(len(devices), dtype=numpy.int64)
+
+        # Fan speeds, as _check_fan
+        isFan = types == 2
+        fanValues = values[isFan]
+        fanUnits = units[isFan]
+        fanValues = numpy.where(fanValues > 0xffff, fanValues & 0xffff,
+                                fanValues)
+        fanSpeeds = numpy.where(fanUnits == 1, fanValues, 0)
+
+        fromOld = fanValues > 10000
+        fromNew = ~fromOld & ((fanUnits == 0) | (fanUnits == -1))
+
+        for table, selected in ((fanSpeedsOld, fromOld),
+                                (fanSpeedsNew, fromNew)):
+            keys = numpy.array(sorted(table), dtype=numpy.int64)
+            speeds = numpy.array([table[key] for key in sorted(table)],
+                                 dtype=numpy.int64)
+            positions = numpy.searchsorted(keys, fanValues[selected])
+            positions = numpy.minimum(positions, len(keys) - 1)
+
+            if not (keys[positions] == fanValues[selected]).all():
+                return False
+
+            fanSpeeds[selected] = speeds[positions]
+
+        readings[isFan] = fanSpeeds
+
+        # Temperatures in Celsius, as _check_temp_sensor
+        isTemp = (types == 3) | (types == 8)
+        tempValues = values[isTemp]
+        tempValues = numpy.where(tempValues > 0xffff, tempValues >> 16,
+                                 tempValues)
+        readings[isTemp] = numpy.where(tempValues == 0, 0,
+                                       (tempValues * units[isTemp] // 1000) -
+                                       273)
+
+        # The status bits of every reported row, grouped by device type
+        reported = ((statuses != 0) & (types != 15) &
+                    ~((types == 4) & (statuses == 255)))
+        messages = dict([(position, []) for position in
+                         numpy.flatnonzero(reported).tolist()])
+        counts = {'critical':0, 'warning':0}
+
+        for deviceType in numpy.unique(types[reported]).tolist():
+            positions = numpy.flatnonzero(reported & (types == deviceType))
+            group = statuses[positions]
+
+            for shift, mask, outcomes in _compiledStatusRules.get(deviceType,
+                                                                  []):
+                fields = (group >> shift) & mask
+
+                for field, (message, severity) in outcomes.items():
+                    hits = positions[fields == field].tolist()
+
+                    if severity:
+                        counts[severity] += len(hits)
+
+                    for position in hits:
+                        messages[position].append((message, severity))
+
+        # The fan speed warnings of _check_fan compare the speed to a
+        # string and never fire, so there is nothing more to report
+        readings = readings.tolist()
+
+        for position in numpy.flatnonzero(isFan | isTemp).tolist():
+            if isFan[position]:
+                limits = (5713, 5800, 0, 6000)
+            else:
+                limits = (70, 80, 0, 100)
+
+            self._add_perfdata(devices[position][0], readings[position],
+                               *limits)
+
+        for position in sorted(messages):
+            description = devices[position][0]
+            self._add_output(' '.join([description + ':'] +
+                                      [message % {'description':description}
+                                       for message, severity in
+                                       messages[position]]),
+                             description,
+                             worst_severity([severity for message, severity
+                                             in messages[position]]),
+                             devices[position][4])
+
+        for severity in counts:
+            self.state[severity] += counts[severity]
+
+        return True
+
     def check_drive_status(self):
         '''
         Check the Hard Drive Status of the RAID and return the result.
@@ -1295,6 +3831,31 @@ class CheckInfortrend(Snmp):
         Logical Disk Failed Drive Count
         Logical Disk Status and parse the results for any error conditions
         Hard Drive Status and parse the results for any error conditions
+
+        With a cache the model and serial number of a failed drive are
+        only asked for on the poll it fails in.
+
+        >>> import infortrend_simulator
+        >>> simulator = infortrend_simulator.InfortrendSimulator(
+        ...     infortrend_simulator.synthetic_tree(failed_drives=3))
+        >>> simulator.start()
+        >>> check = CheckInfortrend([], agent='127.0.0.1:%d' % simulator.port,
+        ...                         cache_dir=tempfile.mkdtemp())
+        >>> check.base_oid = '1.3.6.1.4.1.1714.1.'
+        >>> gets = []
+        >>> query_many = check.query_many
+        >>> check.query_many = lambda oids: (gets.append(oids) or
+        ...                                  query_many(oids))
+        >>> check.check_drive_status()
+        >>> len(gets), len(gets[0])
+        (1, 6)
+        >>> check.reset()
+        >>> check.check_drive_status()
+        >>> len(gets)
+        1
+        >>> check.parse_results()[0]
+        2
+        >>> simulator.stop()
         '''
 
         ldTotalDrvCnt = ('Logical Drives:', self.base_oid + '1.2.1.8',
@@ -1309,27 +3870,33 @@ class CheckInfortrend(Snmp):
                      'snmpwalk')
 
 
+        # None of these depend on each other so they may run in parallel
+        results = self._query_all([ldTotalDrvCnt, ldSpareDrvCnt,
+                                   ldFailedDrvCnt, ldStatus, hddStatus])
+
         # Get the logical drive count
-        check, driveCount = self._query(ldTotalDrvCnt)
+        check, driveCount = results[0]
         driveCount = ','.join(['%s' % element for element in driveCount])
-        self.output.append(check + driveCount)
+        self._add_output(check + driveCount, 'Logical Drives')
 
         # Get the spare drive count
-        check, spareCount = self._query(ldSpareDrvCnt)
+        check, spareCount = results[1]
         spareCount = ','.join(['%s' % element for element in spareCount])
-        self.output.append(check + spareCount)
+        self._add_output(check + spareCount, 'Spare Drives')
 
         # Get the failed drive count
-        check, failedCount = self._query(ldFailedDrvCnt)
+        check, failedCount = results[2]
         failedCount = ','.join(['%s' % element for element in failedCount])
-        self.output.append(check + failedCount)
+        self._add_output(check + failedCount, 'Failed Drives')
 
         # Get the logical disk status
-        check, logicalDriveStatus = self._query(ldStatus)
+        check, logicalDriveStatus = results[3]
+        self.readings['logical_drives'] = list(logicalDriveStatus)
         self._check_ld_status(logicalDriveStatus)
 
         # Get the status of the hard drives
-        check, driveStatus =  self._query(hddStatus)
+        check, driveStatus = results[4]
+        self.readings['drives'] = list(driveStatus)
         self._check_hdd_status(driveStatus)
 
         if self.verbose > 0:
@@ -1342,6 +3909,9 @@ class CheckInfortrend(Snmp):
         Pull the system's make, model, serial number, firmware major and minor
         numbers. Expects no arguments to be passed in.
 
+        The values are kept in the cache for inventory_ttl seconds, or
+        until the serial number seen by auto_detect changes.
+
         This method expects no arguments.
         '''
 
@@ -1356,43 +3926,77 @@ class CheckInfortrend(Snmp):
         fwMinorVersion = ('Firmware Minor Version:',
                           self.base_oid + '1.1.1.5.0', 'snmpget')
 
-        # Get the vendor string
-        check, vendor = self._query(privateLogoVendor)
-        self.output.append(check + vendor)
+        # These only change with a firmware upgrade or a different array
+        inventory = None
 
-        # Get the Manufacturers model
-        check, model = self._query(privateLogoString)
-        self.output.append(check + model)
+        if self.cache:
+            inventory = self.cache.get('inventory', self.inventory_ttl)
 
-        # Get the serial number
-        check, serialNumber = self._query(serialNum)
-        self.output.append('%s %s' % (check, serialNumber))
+            if (inventory and self.serial_number is not None and
+                inventory[2] != self.serial_number):
+                if self.verbose > 0:
+                    print 'Debug1: Serial number changed, refreshing inventory'
+                inventory = None
 
-        # Get the major and minor firmware versions
-        check, firmwareMajor = self._query(fwMajorVersion)
-        check, firmwareMinor = self._query(fwMinorVersion)
-        self.output.append('Firmware Version:%s.%s' % (firmwareMajor,
-                                                       firmwareMinor))
+        if inventory:
+            vendor, model, serialNumber, firmwareMajor, firmwareMinor = \
+                inventory
+        else:
+            # The vendor, model, serial number and firmware versions all
+            # come back from one GET
+            inventory = [result for check, result in self._query_scalars(
+                [privateLogoVendor, privateLogoString, serialNum,
+                 fwMajorVersion, fwMinorVersion])]
+
+            vendor, model, serialNumber, firmwareMajor, firmwareMinor = \
+                inventory
+
+            if self.cache and not (set(inventory) &
+                                   set([NO_SUCH_OBJECT, NO_SUCH_INSTANCE])):
+                self.cache.set('inventory', inventory)
+
+        self._add_output(privateLogoVendor[0] + vendor, 'Vendor')
+        self._add_output(privateLogoString[0] + model, 'Model')
+        self._add_output('%s %s' % (serialNum[0], serialNumber),
+                         'Serial Number')
+        self._add_output('Firmware Version:%s.%s' % (firmwareMajor,
+                                                     firmwareMinor),
+                         'Firmware Version')
 
         if self.verbose > 0:
             print 'Debug1: Output from checkModelFirmware:', self.output
 
         return None
 
-    def _convertBinarytoInteger(self, binary):
+    def _report_status(self, deviceType, deviceDescription, status,
+                       sensorValue):
         '''
-        Convert the given binary string to an integer. Appends 0b to the
-        string before conversion.
+        For internal use, decodes status with the luDevStatusRules of
+        deviceType, raises the state counters and, unless status is 0,
+        adds the output line. Returns the output line as a list.
         '''
 
-        return int('0b' + binary, 2)
+        outputLine = [deviceDescription + ':'] # Begin our output line
 
-    def _convertIntegerToBinaryAndFormat(self, number):
-        '''
-        Convert the given integer to a number and removes the leading 0b
-        and returns.
-        '''
-        return bin(number)[2:]
+        # If status is 0 everything is copacetic
+        if status != 0:
+            if self.verbose > 0:
+                print ('Debug1: Device:%s, Value:%s, Status code:%s '
+                       'binary:%s') % (deviceDescription, sensorValue,
+                                       status, bin(status)[2:])
+
+            decoded = decode_status(deviceType, status)
+
+            for message, severity in decoded:
+                outputLine.append(message % {'description':deviceDescription})
+                if severity:
+                    self.state[severity] += 1
+
+            self._add_output(' '.join(outputLine), deviceDescription,
+                             worst_severity([severity for message, severity
+                                             in decoded]), status)
+
+        return outputLine
 
     def _parse_blacklist(self, blacklist):
         '''
@@ -1406,45 +4010,53 @@ class CheckInfortrend(Snmp):
         else:
             return []
 
-    def parse_print_exit(self):
+    def parse_print_exit(self, output_format='text'):
         '''
-        Parse the results, print the output and exit with the appropriate
+        Parse the results, print the output, as the Nagios line or with
+        output_format 'json' as JSON, and exit with the appropriate
         status.
         '''
 
-        finalOutput = '%s:%s'
-
-        if self.verbose > 0:
-            print ('Debug1: Results passed to parsePrint: '
-                   '%s %s') % (self.state, self.output)
+        result = self.result()
 
-        if self.state['critical']:
-            status = 'CRITICAL'
-        elif self.state['warning']:
-            status = 'WARNING'
-        elif self.state['unknown']:
-            status = 'UNKNOWN'
+        if output_format == 'json':
+            print json.dumps(result.as_dict(), sort_keys=True)
         else:
-            status = 'OK'
+            print result.nagios()[1]
+
+        sys.exit(result.exit_code)
 
-        finalLine = ''
+        return None # Should never be reached
 
-        for line in self.output:
-            finalLine += ' ' + line + ' '
+    def parse_results(self):
+        '''
+        Parse the results and return a tuple of the Nagios exit code and
+        the line of output the plugin prints.
+        '''
 
-        # Add in performance data if it exists
-        if self.perfData:
-            finalLine += '| '
-            for line in self.perfData:
-                finalLine += line + ' '
+        return self.result().nagios()
 
-        # Construct and print our final output
-        finalOutput = finalOutput % (status, finalLine)
-        print finalOutput
+    def result(self):
+        '''
+        Returns the results of the last run as a CheckResult.
+        '''
+
+        if self.verbose > 0:
+            print ('Debug1: Results passed to parsePrint: '
+                   '%s %s') % (self.state, self.output)
 
-        sys.exit(eval(status))
+        codes = {'drives':self.readings.get('drives', []),
+                 'logical_drives':self.readings.get('logical_drives', []),
+                 'devices':[{'index':index, 'description':description,
+                             'type':device, 'value':value,
+                             'value_unit':valueUnit, 'status':status}
+                            for index, (description, device, value,
+                                        valueUnit, status)
+                            in self.readings.get('devices', [])],
+                 }
 
-        return None # Should never be reached
+        return CheckResult(self.agent, dict(self.state), list(self.output),
+                           list(self.perfData), codes)
 
     def _query(self, items):
         '''
@@ -1456,13 +4068,119 @@ class CheckInfortrend(Snmp):
         '''
 
         check, oid, snmpCmd = items
-        result = self.query(snmpCmd, oid)
+
+        if snmpCmd == 'snmpget' and oid in self.scalars:
+            result = self.scalars[oid]
+        else:
+            result = self.query(snmpCmd, oid)
+
+        if result in (NO_SUCH_OBJECT, [NO_SUCH_OBJECT]):
+            oid = self._redetect_base_oid(oid)
+            if oid:
+                result = self.query(snmpCmd, oid)
 
         if self.verbose > 1:
             print 'Debug2:', check, result
 
         return check, result
 
+    def _query_scalars(self, items):
+        '''
+        For internal use, GETs every item of the list items, tuples in the
+        same form _query takes, in one multi-varbind request. Those
+        already fetched during this run, the serial number the detection
+        probe answered for one, are not asked for again. Returns a list of
+        (check, result) tuples in the same order.
+        '''
+
+        oids = [oid for check, oid, snmpCmd in items]
+        missing = [oid for oid in oids if oid not in self.scalars]
+
+        if missing:
+            self.scalars.update(zip(missing, self.query_many(missing)))
+
+        results = [self.scalars[oid] for oid in oids]
+
+        if results == [NO_SUCH_OBJECT] * len(items):
+            oids = [self._redetect_base_oid(oid) for oid in oids]
+            if None not in oids:
+                results = self.query_many(oids)
+                self.scalars.update(zip(oids, results))
+
+        if self.verbose > 1:
+            for (check, oid, snmpCmd), result in zip(items, results):
+                print 'Debug2:', check, result
+
+        return [(check, result)
+                for (check, oid, snmpCmd), result in zip(items, results)]
+
+    def _redetect_base_oid(self, oid):
+        '''
+        For internal use, called when a query under a cached base OID
+        found nothing. Throws the cached base OID away, detects it again
+        and returns oid moved under the new base OID, or None if the base
+        OID did not come from the cache or has not changed.
+        '''
+
+        with self.detect_lock:
+            staleBase = self.stale_base_oid
+
+            if (not staleBase or not oid.startswith(staleBase) or
+                staleBase == self.base_oid):
+                # Only the first failure under a cached base OID detects
+                if not self.base_oid_cached:
+                    return None
+
+                if self.verbose > 0:
+                    print 'Debug1: Cached base OID failed, detecting again'
+
+                staleBase = self.stale_base_oid = self.base_oid
+
+                # Long-lived checks remember the base OID without a cache
+                if self.cache:
+                    self.cache.delete('base_oid')
+
+                self.auto_detect(use_cache=False)
+
+        if self.base_oid == staleBase:
+            return None
+
+        # OIDs built before detection ran again are still under the old one
+        return self.base_oid + oid[len(staleBase):]
+
+    def _query_all(self, items):
+        '''
+        For internal use, runs _query for every tuple in the list items,
+        in parallel when more than one worker is allowed. Returns a list
+        of the (check, result) tuples in the same order.
+        '''
+
+        return _run_concurrently([lambda item=item: self._query(item)
+                                  for item in items], self.workers)
+
+    def _query_table(self, items):
+        '''
+        For internal use, fetches a table. Requires one input, a list of
+        tuples in the same form _query takes, one per column. Returns the
+        rows from query_table.
+        '''
+
+        rows = self.query_table([oid for check, oid, snmpCmd in items])
+
+        if not rows or [NO_SUCH_OBJECT] * len(items) in rows.values():
+            oids = [self._redetect_base_oid(oid)
+                    for check, oid, snmpCmd in items]
+            if None not in oids:
+                rows = self.query_table(oids)
+
+        if self.verbose > 1:
+            for column, (check, oid, snmpCmd) in enumerate(items):
+                print 'Debug2:', check, [rows[index][column]
+                                         for index in sorted(rows,
+                                                             key=_oid_tuple)]
+
+        return rows
+
 #    def _test(self):
 #        '''
 #        For internal use, runs doctests against the module.
@@ -1472,16 +4190,722 @@ class CheckInfortrend(Snmp):
 #
 #        return None
 
-def sigalarm_handler(signum, frame):
+def read_hosts_file(file_path, community='public', blacklist=None):
+    '''
+    Read a hosts file for batch mode. Each line holds a host and
+    optionally a community and a blacklist separated by whitespace, blank
+    lines and lines starting with # are ignored. Missing columns take the
+    values passed in. Returns a list of (host, community, blacklist)
+    tuples.
+    '''
+
+    hosts = []
+
+    for line in open(file_path):
+        fields = line.split('#')[0].split()
+
+        if not fields:
+            continue
+
+        fields += [community, blacklist][len(fields) - 1:]
+        hosts.append(tuple(fields[:3]))
+
+    return hosts
+
+def _failure(host, error):
+    '''
+    For internal use, returns a tuple of the UNKNOWN exit code and the
+    output for an exception, other than CheckError, raised while checking
+    host, so one broken host never stops the others being checked.
+
+    >>> _failure('raid1', TypeError('bad row'))
+    (3, 'UNKNOWN: checking raid1 failed: TypeError: bad row')
+    '''
+    return UNKNOWN, ('UNKNOWN: checking %s failed: %s: %s'
+                     % (host, error.__class__.__name__, error))
+
+def poll_host(host, community='public', blacklist=None, **settings):
+    '''
+    Run all of the checks against one RAID without printing or exiting.
+    Any further keyword arguments are passed on to CheckInfortrend.
+    Returns a tuple of the Nagios exit code, the plugin output and the
+    start and finish times of the checks. Whatever the checks raise is
+    turned into an UNKNOWN result for this host alone.
+    '''
+
+    startTime = time.time()
+
+    try:
+        check = CheckInfortrend(blacklist=blacklist, community=community,
+                                agent=host, **settings)
+        check.run_checks()
+        exitCode, output = check.parse_results()
+    except CheckError, error:
+        exitCode, output = error.status, str(error)
+    except Exception, error:
+        exitCode, output = _failure(host, error)
+
+    return exitCode, output, startTime, time.time()
+
+
+class PassiveResultWriter(object):
+    '''
+    Hands check results to Nagios as passive service check results.
+
+    There are three optional arguments that are passed to the init
+    constructor:
+
+    service: a string giving the service description results are for
+    command_file: a string, path of the Nagios external command file
+    spool_dir: a string, path of the Nagios checkresults spool directory
+
+    If spool_dir is given a checkresult file is written for every result,
+    otherwise PROCESS_SERVICE_CHECK_RESULT commands are written to the
+    command file, or printed when there is no command file either.
+    '''
+
+    def __init__(self, service='RAID', command_file=None, spool_dir=None):
+
+        self.service = service
+        self.command_file = command_file
+        self.spool_dir = spool_dir
+
+        # Results arrive from several threads at once
+        self.lock = threading.Lock()
+
+    def write(self, host, exitCode, output, startTime, finishTime):
+        '''
+        Write the result of one host.
+        '''
+
+        # Nagios expects multiple lines of output escaped
+        output = output.strip().replace('\n', '\\n')
+
+        with self.lock:
+            if self.spool_dir:
+                self._write_checkresult(host, exitCode, output, startTime,
+                                        finishTime)
+            else:
+                command = ('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%s;%s\n'
+                           % (finishTime, host, self.service, exitCode,
+                              output))
+
+                if self.command_file:
+                    commandFile = open(self.command_file, 'a')
+                    try:
+                        commandFile.write(command)
+                    finally:
+                        commandFile.close()
+                else:
+                    sys.stdout.write(command)
+                    sys.stdout.flush()
+
+        return None
+
+    def _write_checkresult(self, host, exitCode, output, startTime,
+                           finishTime):
+        '''
+        For internal use, writes a checkresult file and its .ok marker to
+        the spool directory.
+        '''
+
+        result = ('### Passive Check Result File ###\n'
+                  'file_time=%d\n\n'
+                  '### Nagios Service Check Result ###\n'
+                  '# Time: %s\n'
+                  'host_name=%s\n'
+                  'service_description=%s\n'
+                  'check_type=1\n'
+                  'check_options=0\n'
+                  'scheduled_check=0\n'
+                  'reschedule_check=0\n'
+                  'latency=0.0\n'
+                  'start_time=%f\n'
+                  'finish_time=%f\n'
+                  'early_timeout=0\n'
+                  'exited_ok=1\n'
+                  'return_code=%d\n'
+                  'output=%s\n') % (finishTime, time.ctime(finishTime), host,
+                                    self.service, startTime, finishTime,
+                                    exitCode, output)
+
+        descriptor, file_path = tempfile.mkstemp(prefix='c',
+                                                 dir=self.spool_dir)
+        resultFile = os.fdopen(descriptor, 'w')
+        try:
+            resultFile.write(result)
+        finally:
+            resultFile.close()
+
+        # Nagios only reads result files once the .ok file exists
+        open(file_path + '.ok', 'w').close()
+
+        return None
+
+
+def run_batch(hosts, writer, concurrency=32, **settings):
+    '''
+    Check every host in hosts, a list of (host, community, blacklist)
+    tuples, using up to concurrency threads in this one process. Each
+    result is handed to writer as soon as its host is done. Any further
+    keyword arguments are passed on to CheckInfortrend.
+    '''
+
+    def check_host(host, community, blacklist):
+        '''
+        Poll one host and write out its result.
+        '''
+        result = poll_host(host, community, blacklist, **settings)
+        writer.write(host, *result)
+
+        return result[0]
+
+    return _run_concurrently([lambda host=host: check_host(*host)
+                              for host in hosts], concurrency)
+
+def fleet_size(concurrency=32, processes=0, workers=1, backend='native',
+               nofile=None, socket_pool=0):
+    '''
+    Returns a tuple of the number of processes and of threads in each
+    that run_fleet should use. processes of 0 means one per core. The
+    threads are concurrency, unless the open file limit, nofile or the
+    soft RLIMIT_NOFILE, can't hold the descriptors that many polls need:
+    one per parallel query of each poll, none with a socket_pool, three
+    with the net-snmp tools, and one for its cache or history file.
+
+    >>> fleet_size(32, processes=4, nofile=1024)
+    (4, 32)
+    >>> fleet_size(32, processes=4, workers=2, nofile=128)
+    (4, 32)
+    >>> fleet_size(32, processes=4, backend='subprocess', nofile=128)
+    (4, 24)
+    >>> fleet_size(256, processes=4, workers=4, nofile=1024, socket_pool=4)
+    (4, 256)
+    '''
+    if not processes:
+        processes = multiprocessing.cpu_count()
+
+    if nofile is None:
+        nofile = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+    # Left for the interpreter, the queues and the result files
+    reserved = 32
+
+    if backend == 'subprocess':
+        perPoll = workers * 3 + 1
+    elif socket_pool:
+        perPoll = 1
+        reserved += socket_pool * 2 + 2
+    else:
+        perPoll = workers + 1
+
+    return processes, max(1, min(concurrency,
+                                 (nofile - reserved) // perPoll))
+
+def _fleet_worker(tasks, results, threads, settings):
+    '''
+    For internal use, the body of a run_fleet process. Each of its
+    threads takes one host at a time off the shared tasks queue, until it
+    takes None, and puts the result on the results queue.
+    '''
+
+    def poll_hosts():
+        '''
+        Poll hosts until told to stop.
+        '''
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            position, host, community, blacklist = task
+            results.put((position, host) +
+                        poll_host(host, community, blacklist, **settings))
+
+    _run_concurrently([poll_hosts] * threads, threads)
+
+    return None
+
+def run_fleet(hosts, writer, processes=0, concurrency=32, **settings):
+    '''
+    Check every host in hosts, a list of (host, community, blacklist)
+    tuples, spread over processes processes of up to concurrency
+    threads each, sized with fleet_size. The hosts are not divided
+    between the processes up front, every thread takes the next host off
+    one shared queue when it is free, so a few slow arrays only hold up
+    the threads polling them. Each result is handed to writer, in this
+    process, as soon as its host is done. Returns the exit codes in the
+    order of hosts. Any further keyword arguments are passed on to
+    CheckInfortrend.
+    '''
+
+    processes, threads = fleet_size(concurrency, processes,
+                                    settings.get('workers', 1),
+                                    settings.get('backend', 'native'),
+                                    socket_pool=settings.get('socket_pool', 0))
+    processes = max(1, min(processes, len(hosts)))
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+
+    for position, host in enumerate(hosts):
+        tasks.put((position,) + tuple(host))
+
+    for thread in range(processes * threads):
+        tasks.put(None)
+
+    workers = [multiprocessing.Process(target=_fleet_worker,
+                                       args=(tasks, results, threads,
+                                             settings))
+               for process in range(processes)]
+
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    exitCodes = [None] * len(hosts)
+    finished = 0
+
+    try:
+        while finished < len(hosts):
+            try:
+                result = results.get(timeout=1)
+            except Queue.Empty:
+                if not [worker for worker in workers if worker.is_alive()]:
+                    break
+                continue
+
+            position, host = result[:2]
+            exitCodes[position] = result[2]
+            finished += 1
+            writer.write(host, *result[2:])
+    finally:
+        for worker in workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+
+    # Whatever a crashed worker had taken is never coming back
+    for position, (host, community, blacklist) in enumerate(hosts):
+        if exitCodes[position] is None:
+            exitCodes[position] = UNKNOWN
+            writer.write(host, UNKNOWN, 'UNKNOWN: the worker checking %s '
+                         'exited' % (host), time.time(), time.time())
+
+    return exitCodes
+
+class CollectorDaemon(object):
+    '''
+    Long running collector, polls every host on a schedule and keeps the
+    latest result of each in memory for thin clients to ask for over a
+    Unix socket. The CheckInfortrend instances, and with them the SNMP
+    sessions, base OIDs and caches, live as long as the daemon does.
+
+    hosts: a list of (host, community, blacklist) tuples
+    socket_path: a string, the Unix socket to listen on
+    interval: an integer, seconds between the start of each poll
+    concurrency: an integer, number of hosts polled at once
+    Any further keyword arguments are passed on to CheckInfortrend.
+    '''
+
+    def __init__(self, hosts, socket_path, interval=300, concurrency=32,
+                 **settings):
+
+        self.socket_path = socket_path
+        self.interval = interval
+        self.concurrency = concurrency
+
+        self.checks = {}
+        for host, community, blacklist in hosts:
+            self.checks[host] = CheckInfortrend(blacklist=blacklist,
+                                                community=community,
+                                                agent=host, **settings)
+
+        # host: (exit code, output, finish time)
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def poll(self, host):
+        '''
+        Check one host and store the result.
+        '''
+
+        check = self.checks[host]
+        check.reset()
+
+        try:
+            check.run_checks()
+            exitCode, output = check.parse_results()
+        except CheckError, error:
+            exitCode, output = error.status, str(error)
+        except Exception, error:
+            exitCode, output = _failure(host, error)
+
+        with self.lock:
+            self.results[host] = (exitCode, output, time.time())
+
+        return exitCode
+
+    def poll_all(self):
+        '''
+        Check every host once.
+        '''
+
+        return _run_concurrently([lambda host=host: self.poll(host)
+                                  for host in sorted(self.checks)],
+                                 self.concurrency)
+
+    def schedule(self):
+        '''
+        Poll every host each interval seconds, forever.
+        '''
+
+        while True:
+            startTime = time.time()
+
+            # poll catches what a host raises, this keeps the schedule
+            # going whatever else goes wrong
+            try:
+                self.poll_all()
+            except Exception, error:
+                print >> sys.stderr, 'Polling failed: %s: %s' % (
+                    error.__class__.__name__, error)
+
+            time.sleep(max(0, startTime + self.interval - time.time()))
+
+    def get_result(self, host):
+        '''
+        Returns the latest result for host as a dictionary holding the
+        status, the output and its age in seconds.
+        '''
+
+        with self.lock:
+            result = self.results.get(host)
+
+        if host not in self.checks:
+            return {'status':UNKNOWN, 'age':0,
+                    'output':'UNKNOWN: %s is not polled by the collector'
+                             % (host)}
+        elif result is None:
+            return {'status':UNKNOWN, 'age':0,
+                    'output':'UNKNOWN: no result for %s yet' % (host)}
+
+        return {'status':result[0], 'output':result[1],
+                'age':time.time() - result[2]}
+
+    def serve_forever(self):
+        '''
+        Start polling in the background and answer clients until killed.
+        '''
+
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            '''
+            Reads one hostname per connection and answers with its result
+            as JSON.
+            '''
+            def handle(self):
+                host = self.rfile.readline().strip()
+                self.wfile.write(json.dumps(daemon.get_result(host)) + '\n')
+
+        class Server(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        server = Server(self.socket_path, Handler)
+
+        scheduler = threading.Thread(target=self.schedule)
+        scheduler.daemon = True
+        scheduler.start()
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket_path)
+
+        return None
+
+def query_daemon(socket_path, host, timeout=10, max_age=None):
+    '''
+    Thin client, asks the collector daemon listening on socket_path for
+    the latest result of host. Returns a tuple of the Nagios exit code
+    and the plugin output. Results older than max_age seconds are
+    reported as UNKNOWN.
+    '''
+
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        try:
+            client.connect(socket_path)
+            client.sendall(host + '\n')
+            response = client.makefile().readline()
+        finally:
+            client.close()
+
+        result = json.loads(response)
+    except (socket.error, ValueError), error:
+        return UNKNOWN, ('UNKNOWN: unable to get a result from the collector '
+                         'at %s: %s' % (socket_path, error))
+
+    output = result['output'].encode('utf-8')
+
+    if max_age is not None and result['age'] > max_age:
+        return UNKNOWN, ('UNKNOWN: last result is %d seconds old: %s'
+                         % (result['age'], output))
+
+    return result['status'], output
+
+def _metric_line(name, labels, value):
+    '''
+    For internal use, formats one OpenMetrics sample, labels is a list of
+    (name, value) tuples.
+
+    >>> print _metric_line('infortrend_drive_status',
+    ...                    [('host', 'raid1'), ('drive', '1')], 255)
+    infortrend_drive_status{host="raid1",drive="1"} 255
+    '''
+    escaped = ['%s="%s"' % (label, str(text).replace('\\', '\\\\')
+                            .replace('"', '\\"').replace('\n', '\\n'))
+               for label, text in labels]
+
+    return '%s{%s} %s' % (name, ','.join(escaped), value)
+
+
+class MetricsExporter(object):
     '''
-    Handler for an alarm situation.
+    HTTP exporter, serves the state of every host as OpenMetrics gauges
+    for Prometheus to scrape. Hosts are checked with the same run_checks
+    as the plugin, when scraped, and the result is kept for ttl seconds.
+    However many scrapers there are, and however often they scrape, each
+    array is polled at most once per ttl: a scrape arriving while a host
+    is being polled waits for that poll instead of starting another.
+
+    hosts: a list of (host, community, blacklist) tuples
+    address: a tuple of the address and port to listen on
+    ttl: an integer, seconds a poll is served from the cache
+    concurrency: an integer, number of hosts polled at once
+    Any further keyword arguments are passed on to CheckInfortrend.
     '''
 
-    print ('%s timed out after %s seconds, '
-           'signum:%s, frame: %s') % (sys.argv[0], options.timeout,
-                                      signum, frame)
+    # Name and help of every metric, in the order they are served
+    metrics = (('infortrend_up',
+                'Whether the last poll completed within the timeout'),
+               ('infortrend_check_status',
+                'Nagios exit code of the last poll'),
+               ('infortrend_state_count',
+                'Components in each state at the last poll'),
+               ('infortrend_drive_status', 'hddStatus code of each drive'),
+               ('infortrend_logical_drive_status',
+                'ldStatus code of each logical drive'),
+               ('infortrend_device_status',
+                'luDevStatus code of each device'),
+               ('infortrend_temperature_celsius',
+                'Temperature of each temperature sensor'),
+               ('infortrend_fan_speed_rpm', 'Speed of each fan'),
+               ('infortrend_voltage_volts',
+                'Voltage of each voltage sensor'),
+               ('infortrend_poll_duration_seconds',
+                'Wall time of the last poll'),
+               ('infortrend_poll_timestamp_seconds',
+                'Time the last poll finished'),
+               )
+
+    def __init__(self, hosts, address, ttl=60, concurrency=32, **settings):
+
+        self.address = address
+        self.ttl = ttl
+        self.concurrency = concurrency
+
+        self.checks = {}
+        self.locks = {}
+        for host, community, blacklist in hosts:
+            self.checks[host] = CheckInfortrend(blacklist=blacklist,
+                                                community=community,
+                                                agent=host, **settings)
+            self.locks[host] = threading.Lock()
+
+        # host: (samples, finish time)
+        self.results = {}
+
+    def poll(self, host):
+        '''
+        Returns the samples of host, a list of (name, labels, value)
+        tuples, checking it first if its last poll is older than ttl.
+        '''
+
+        with self.locks[host]:
+            result = self.results.get(host)
+
+            if result is None or time.time() - result[1] >= self.ttl:
+                result = (self._collect(host), time.time())
+                self.results[host] = result
+
+        return result[0]
+
+    def _collect(self, host):
+        '''
+        For internal use, checks host and returns its samples.
+        '''
+
+        check = self.checks[host]
+        check.reset()
+        startTime = time.time()
+
+        try:
+            check.run_checks()
+            exitCode = check.parse_results()[0]
+            # A run cut short by the timeout does not raise, but the
+            # array did not answer
+            up = int(not check.timed_out)
+        except CheckError, error:
+            exitCode = error.status
+            up = 0
+        except Exception, error:
+            exitCode = _failure(host, error)[0]
+            up = 0
+
+        hostLabel = [('host', host)]
+        samples = [('infortrend_up', hostLabel, up),
+                   ('infortrend_check_status', hostLabel, exitCode)]
+
+        for severity in sorted(check.state):
+            samples.append(('infortrend_state_count',
+                            hostLabel + [('severity', severity)],
+                            check.state[severity]))
+
+        for drive, status in enumerate(check.readings.get('drives', [])):
+            samples.append(('infortrend_drive_status',
+                            hostLabel + [('drive', drive + 1)], status))
+
+        for drive, status in enumerate(check.readings.get('logical_drives',
+                                                          [])):
+            samples.append(('infortrend_logical_drive_status',
+                            hostLabel + [('logical_drive', drive + 1)],
+                            status))
+
+        sensors = {2:('infortrend_fan_speed_rpm', check._fan_speed),
+                   3:('infortrend_temperature_celsius', check._temperature),
+                   5:('infortrend_voltage_volts', check._voltage),
+                   8:('infortrend_temperature_celsius', check._temperature),
+                   }
+
+        for index, (description, device, value, valueUnit, status) in \
+            check.readings.get('devices', []):
+            labels = hostLabel + [('index', index),
+                                  ('description', description)]
+
+            if status is not None:
+                samples.append(('infortrend_device_status',
+                                labels + [('type', device)], status))
+
+            if device in sensors and value is not None and \
+                valueUnit is not None:
+                name, reading = sensors[device]
+                samples.append((name, labels, reading(value, valueUnit)))
+
+        samples.append(('infortrend_poll_duration_seconds', hostLabel,
+                        '%.3f' % (time.time() - startTime)))
+        samples.append(('infortrend_poll_timestamp_seconds', hostLabel,
+                        '%.3f' % (time.time())))
+
+        return samples
+
+    def render(self, hosts, openmetrics=True):
+        '''
+        Returns the samples of the list hosts in the text exposition
+        format, or in the OpenMetrics one, polling the hosts whose result
+        is older than ttl.
+        '''
+
+        polled = _run_concurrently([lambda host=host: self.poll(host)
+                                    for host in hosts], self.concurrency)
+
+        byName = {}
+        for samples in polled:
+            for name, labels, value in samples:
+                byName.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, description in self.metrics:
+            if name not in byName:
+                continue
+
+            lines.append('# HELP %s %s.' % (name, description))
+            lines.append('# TYPE %s gauge' % (name))
+
+            for labels, value in byName[name]:
+                lines.append(_metric_line(name, labels, value))
+
+        if openmetrics:
+            lines.append('# EOF')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve_forever(self):
+        '''
+        Answer scrapes of /metrics until killed, ?target=host limits the
+        answer to one of the hosts.
+        '''
+
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            '''
+            Serves /metrics.
+            '''
+            def do_GET(self):
+                url = urlparse.urlparse(self.path)
+                targets = urlparse.parse_qs(url.query).get('target')
+                hosts = sorted(exporter.checks)
+
+                if url.path != '/metrics':
+                    self.send_error(404)
+                    return
+                elif targets:
+                    hosts = [host for host in targets
+                             if host in exporter.checks]
+                    if len(hosts) != len(targets):
+                        self.send_error(404, 'Host is not exported')
+                        return
+
+                openmetrics = 'application/openmetrics-text' in \
+                    self.headers.get('Accept', '')
+                body = exporter.render(hosts, openmetrics)
+
+                self.send_response(200)
+                if openmetrics:
+                    self.send_header('Content-Type',
+                                     'application/openmetrics-text; '
+                                     'version=1.0.0; charset=utf-8')
+                else:
+                    self.send_header('Content-Type',
+                                     'text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return None
+
+        class Server(SocketServer.ThreadingMixIn,
+                     BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server(self.address, Handler)
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
 
-    sys.exit(CRITICAL)
+        return None
 
 if __name__ == '__main__':
     import optparse
@@ -1498,16 +4922,128 @@ if __name__ == '__main__':
     parser.add_option('-b', '--blacklist', action='store', dest='blacklist',
                       type='string', default=None,
                       help=('Checks to blacklist.Use "/" as delimitator (Default: %default) Options:'+blacklist_help))
+    parser.add_option('--backend', action='store', dest='backend',
+                      type='choice', choices=['native', 'subprocess',
+                                              'replay'],
+                      default='native',
+                      help=('SNMP backend, native, subprocess to use the '
+                      'net-snmp tools or replay to answer from the --session '
+                      'file (Default: %default)'))
+    parser.add_option('--cache-dir', action='store', type='string',
+                      dest='cache_dir', default=None,
+                      help=('Directory to keep state between runs in, created '
+                      'with mode 0700, refused if another user owns it or '
+                      'may write to it (Default: no cache)'))
     parser.add_option('-c', '--community', action='store',
                       dest='community', type='string', default='public',
                       help=('SNMP Community String to use. '
                       '(Default: %default)'))
+    parser.add_option('--command-file', action='store', type='string',
+                      dest='command_file', default=None,
+                      help=('Batch mode: Nagios external command file to '
+                      'write passive results to (Default: print them)'))
+    parser.add_option('--concurrency', dest='concurrency', default=32,
+                      type='int', help=('Batch mode: number of hosts to '
+                      'check at once, in each process (Default: '
+                      '%default)'))
+    parser.add_option('-d', '--daemon', action='store_true', dest='daemon',
+                      default=False, help=('Run as a collector daemon polling '
+                      'every host in --hosts-file and answering clients on '
+                      '--socket'))
+    parser.add_option('--detect-ttl', dest='detect_ttl', default=86400,
+                      type='int', help=('Seconds to trust a cached base OID '
+                      'before detecting it again (Default: %default)'))
+    parser.add_option('--exporter', action='store', type='string',
+                      dest='exporter', default=None,
+                      help=('Serve the state of --hostname, or of every host '
+                      'in --hosts-file, as OpenMetrics on [ADDRESS:]PORT '
+                      '/metrics'))
+    parser.add_option('-f', '--hosts-file', action='store', type='string',
+                      dest='hosts_file', default=None,
+                      help=('Batch mode: check every host in this file, one '
+                      '"host [community] [blacklist]" per line, and submit '
+                      'the results as passive checks'))
+    parser.add_option('--history', action='store_true', dest='history',
+                      default=False, help=('Keep the temperature, fan and '
+                      'voltage readings under --cache-dir, which it requires'))
+    parser.add_option('--format', action='store', type='choice',
+                      dest='format', choices=['text', 'json'],
+                      default='text', help=('Print the result as the Nagios '
+                      'line or as JSON (Default: %default)'))
     parser.add_option('-H', '--hostname', action='store', type='string',
                       dest='hostname', default='localhost',
                       help='Specify hostname for SNMP (Default: %default)')
+    parser.add_option('-i', '--interval', dest='interval', default=300,
+                      type='int', help=('Daemon mode: seconds between polls '
+                      'of each host (Default: %default)'))
+    parser.add_option('--inventory-refresh', dest='inventory_ttl',
+                      default=86400, type='int', help=('Seconds to trust '
+                      'the cached vendor, model, serial number and firmware '
+                      'version before asking again (Default: %default)'))
+    parser.add_option('--max-age', dest='max_age', default=None, type='int',
+                      help=('Client mode: report UNKNOWN if the collector\'s '
+                      'result is older than this many seconds'))
+    parser.add_option('--session', action='store', type='string',
+                      dest='session', default=None,
+                      help=('Session file, every SNMP answer is recorded to '
+                      'it, or with --backend replay read from it, the cache '
+                      'is not used'))
+    parser.add_option('--processes', dest='processes', default=1,
+                      type='int', help=('Batch mode: number of processes to '
+                      'spread the hosts over, 0 for one per core '
+                      '(Default: %default)'))
+    parser.add_option('--scrape-ttl', dest='scrape_ttl', default=60,
+                      type='int', help=('Exporter mode: seconds a poll is '
+                      'served to scrapers before polling again '
+                      '(Default: %default)'))
+    parser.add_option('--service', action='store', type='string',
+                      dest='service', default='RAID',
+                      help=('Batch mode: service description of the passive '
+                      'results (Default: %default)'))
+    parser.add_option('-S', '--socket', action='store', type='string',
+                      dest='socket', default=None,
+                      help=('Unix socket of the collector daemon, without '
+                      '--daemon the result for --hostname is fetched from '
+                      'it instead of polling the RAID'))
+    parser.add_option('--show-changes', action='store_true',
+                      dest='show_changes', default=False,
+                      help=('Add the status changes since the previous poll '
+                      'to the output, requires --cache-dir'))
+    parser.add_option('--socket-pool', dest='socket_pool', default=4,
+                      type='int', help=('Batch, daemon and exporter modes: '
+                      'UDP sockets shared by every host polled from a '
+                      'process, 0 for a socket per request (Default: '
+                      '%default)'))
+    parser.add_option('--spool-dir', action='store', type='string',
+                      dest='spool_dir', default=None,
+                      help=('Batch mode: write passive results to this Nagios '
+                      'checkresults directory instead of the command file'))
+    parser.add_option('--temp-rise', action='store', type='string',
+                      dest='temp_rise', default=None,
+                      help=('WARN:CRIT rise in temperature, in degrees '
+                      'Celsius, over --trend-window, keeps the history, '
+                      'requires --cache-dir'))
     parser.add_option('-t', '--timeout', dest='timeout', default=10,
-                      help=('Set the timeout for the program to run '
+                      help=('Set the timeout for the checks of each host, '
+                      'what is not checked by then is reported UNKNOWN '
                       '(Default: %default seconds)'), type='int')
+    parser.add_option('--trace-file', action='store', type='string',
+                      dest='trace_file', default=None,
+                      help=('Write the timing of every SNMP query to this '
+                      'file as JSON, {host} is replaced by the hostname'))
+    parser.add_option('--trace-perfdata', action='store_true',
+                      dest='trace_perfdata', default=False,
+                      help=('Add the time and round trips of each phase of '
+                      'the check to the perfdata'))
+    parser.add_option('--trend-window', dest='trend_window', default=600,
+                      type='int', help=('Seconds the rise in temperature is '
+                      'measured over (Default: %default)'))
+    parser.add_option('--vectorize', action='store_true', dest='vectorize',
+                      default=False, help=('Evaluate the device table with '
+                      'numpy array operations, if numpy is installed'))
+    parser.add_option('--workers', dest='workers', default=1, type='int',
+                      help=('Number of independent SNMP queries to run in '
+                      'parallel (Default: %default)'))
     parser.add_option('-v', '--verbose', action='count', dest='verbose',
                       default=0, help=('Give verbose output '
                       '(Default: Off)') )
@@ -1518,17 +5054,120 @@ if __name__ == '__main__':
         print 'Debug1: Options taken in:', options
         print 'Debug1: Arguments taken in:', args
 
-    signal.signal(signal.SIGALRM, sigalarm_handler)
+    if options.cache_dir:
+        try:
+            _private_directory(options.cache_dir)
+        except OSError, error:
+            parser.error('--cache-dir: %s' % (error))
+
+    tempRise = None
+    if options.temp_rise:
+        try:
+            tempRise = parse_thresholds(options.temp_rise)
+        except ValueError, error:
+            parser.error('--temp-rise: %s' % (error))
+
+    if options.backend == 'replay' and not options.session:
+        parser.error('--backend replay requires --session')
+
+    # These keep their state in the cache, which a session turns off
+    for option, value in (('--history', options.history),
+                          ('--show-changes', options.show_changes),
+                          ('--temp-rise', options.temp_rise)):
+        if value and not options.cache_dir:
+            parser.error('%s requires --cache-dir' % (option))
+
+        if value and options.session:
+            parser.error('%s can not be used with --session' % (option))
 
-    signal.alarm(options.timeout)
+    session = None
+    if options.session:
+        try:
+            session = SnmpSession(options.session,
+                                  ('record', 'replay')[options.backend ==
+                                                       'replay'])
+        except (IOError, ValueError), error:
+            print 'Unable to read session file:', error
+            sys.exit(UNKNOWN)
+
+    # Settings shared by every CheckInfortrend we create
+    settings = {'verbose':options.verbose,
+                'backend':options.backend,
+                'workers':options.workers,
+                'cache_dir':options.cache_dir,
+                'detect_ttl':options.detect_ttl,
+                'inventory_ttl':options.inventory_ttl,
+                'trace_file':options.trace_file,
+                'trace_perfdata':options.trace_perfdata,
+                'session':session,
+                'vectorize':options.vectorize,
+                'timeout':options.timeout,
+                'show_changes':options.show_changes,
+                'history':options.history,
+                'temp_rise':tempRise,
+                'trend_window':options.trend_window,
+                }
+
+    # Only worth its dispatcher thread with many hosts in one process
+    if options.hosts_file or options.daemon or options.exporter:
+        settings['socket_pool'] = options.socket_pool
+
+    if options.daemon:
+        if not options.hosts_file or not options.socket:
+            parser.error('--daemon requires --hosts-file and --socket')
+
+        # Leave through serve_forever's cleanup when told to stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(OK))
+
+        hosts = read_hosts_file(options.hosts_file, options.community,
+                                options.blacklist)
+        CollectorDaemon(hosts, options.socket, options.interval,
+                        options.concurrency, **settings).serve_forever()
+        sys.exit(OK)
+
+    if options.exporter:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(OK))
+
+        address, separator, port = options.exporter.rpartition(':')
+        if not port.isdigit():
+            parser.error('--exporter expects [ADDRESS:]PORT')
+
+        if options.hosts_file:
+            hosts = read_hosts_file(options.hosts_file, options.community,
+                                    options.blacklist)
+        else:
+            hosts = [(options.hostname, options.community, options.blacklist)]
+
+        MetricsExporter(hosts, (address, int(port)), options.scrape_ttl,
+                        options.concurrency, **settings).serve_forever()
+        sys.exit(OK)
+
+    if options.socket:
+        # Thin client, the collector daemon has done the work already
+        exitCode, output = query_daemon(options.socket, options.hostname,
+                                        options.timeout, options.max_age)
+        print output
+        sys.exit(exitCode)
+
+    if options.hosts_file:
+        # Batch mode, each host has a deadline of its own
+        hosts = read_hosts_file(options.hosts_file, options.community,
+                                options.blacklist)
+        writer = PassiveResultWriter(options.service, options.command_file,
+                                     options.spool_dir)
+
+        if options.processes == 1:
+            run_batch(hosts, writer, options.concurrency, **settings)
+        else:
+            run_fleet(hosts, writer, options.processes, options.concurrency,
+                      **settings)
+        sys.exit(OK)
 
     #Instantiate our object
     CHECK = CheckInfortrend(blacklist=options.blacklist,
                             community = options.community,
                             agent = options.hostname,
-                            verbose = options.verbose )
+                            **settings )
 
     #This runs all of the checks
-    CHECK.check_all()
-
-    signal.alarm(0)
+    CHECK.check_all(options.format)
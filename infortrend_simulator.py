@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+
+'''
+Local SNMP agent simulating Infortrend based RAIDs, including the Sun
+StorEdge 3510 and 3511, for testing and benchmarking check_infortrend
+without a real array or any network access.
+
+The OID tree is either loaded from a recorded walk (the output of
+snmpwalk -On) or generated for a synthetic array with any number of
+drives, logical drives and luDev rows, optionally with faults. It can be
+served under any of the base OIDs check_infortrend auto detects.
+
+
+License:
+    check_infortrend, performs SNMP queries against Infortrend based RAIDS
+    Copyright (C) 2012  Erinn Looney-Triggs
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+
+import bisect
+import socket
+import sys
+import threading
+import time
+
+from check_infortrend import (ASN1_INTEGER, ASN1_OCTET_STRING, ASN1_SEQUENCE,
+                              PDU_GET, PDU_GETNEXT, PDU_GETBULK, PDU_RESPONSE,
+                              SNMP_COUNTER32, SNMP_ENDOFMIBVIEW,
+                              SNMP_ERROR_NOSUCHNAME, SNMP_ERROR_TOOBIG,
+                              SNMP_GAUGE32, SNMP_NOSUCHOBJECT, SNMP_TIMETICKS,
+                              SnmpError,
+                              _ber_decode_integer, _ber_decode_oid,
+                              _ber_integer, _ber_oid, _ber_read, _ber_tlv,
+                              _oid_tuple)
+
+# The base OIDs CheckInfortrend.auto_detect knows about
+BASE_OIDS = {'infortrend':'1.3.6.1.4.1.1714.',
+             'infortrend1':'1.3.6.1.4.1.1714.1.',
+             'sun3510':'1.3.6.1.4.1.42.2.180.3510.1.',
+             'sun3511':'1.3.6.1.4.1.42.2.180.3511.1.',
+             }
+
+# Types of walk file values that are kept as integers
+WALK_INTEGER_TYPES = {'INTEGER':ASN1_INTEGER,
+                      'Counter32':SNMP_COUNTER32,
+                      'Gauge32':SNMP_GAUGE32,
+                      'Timeticks':SNMP_TIMETICKS,
+                      }
+
+# A cycle of luDev rows for synthetic arrays:
+# (type, description, value, value unit)
+SYNTHETIC_DEVICES = [(1, 'Power Supply %d', 0, 0),
+                     (2, 'Cooling Fan %d', 4500, 1),
+                     (3, 'Temperature Sensor %d', 313, 1000),
+                     (5, 'Voltage Sensor %d', 12000, 1000),
+                     (12, 'LED %d', 0, 0),
+                     (17, 'Slot %d', 0, 0),
+                     (11, 'Battery %d', 0, 0),
+                     (10, 'Speaker %d', 0, 0),
+                     ]
+
+
+def parse_walk(lines):
+    '''
+    Parse the output of snmpwalk -On into a dictionary of OID to value.
+    Integers of any flavour become integers, or a (tag, integer) tuple
+    when they are not plain INTEGERs, everything else becomes a string.
+
+    >>> tree = parse_walk(['.1.3.6.1.4.1.1714.1.1.1.10.0 = INTEGER: 42',
+    ...                    '.1.3.6.1.4.1.1714.1.1.1.14.0 = STRING: "IFT: 1"',
+    ...                    '.1.3.6.1.4.1.1714.1.1.1.1.0 = Gauge32: 7',
+    ...                    '.1.3.6.1.4.1.1714.1.1.1.2.0 = ""'])
+    >>> tree['1.3.6.1.4.1.1714.1.1.1.10.0']
+    42
+    >>> tree['1.3.6.1.4.1.1714.1.1.1.14.0']
+    'IFT: 1'
+    >>> tree['1.3.6.1.4.1.1714.1.1.1.1.0']
+    (66, 7)
+    >>> tree['1.3.6.1.4.1.1714.1.1.1.2.0']
+    ''
+    '''
+    tree = {}
+    oid = None
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+
+        if ' = ' not in line:
+            # Continuation of a string spanning several lines
+            if oid is not None and isinstance(tree[oid], str):
+                tree[oid] += '\n' + line.rstrip('"')
+            continue
+
+        oid, value = line.split(' = ', 1)
+        oid = oid.strip().strip('.')
+
+        if ': ' in value:
+            style, value = value.split(': ', 1)
+        else:
+            style = 'STRING'
+
+        if style in WALK_INTEGER_TYPES:
+            # Timeticks look like (1234) 0:00:12.34
+            number = int(value.strip('(').split(')')[0].split()[0])
+
+            if style == 'INTEGER':
+                tree[oid] = number
+            else:
+                tree[oid] = (WALK_INTEGER_TYPES[style], number)
+        elif style == 'STRING':
+            tree[oid] = value.strip('"')
+        else:
+            tree[oid] = value
+
+    return tree
+
+def rebase_tree(tree, base_oid):
+    '''
+    Move every OID of tree under base_oid, so a walk recorded from one
+    model can be served as another. The base OID of the walk is found
+    the same way auto_detect does, OIDs outside of it are kept as they
+    are.
+
+    >>> rebase_tree({'1.3.6.1.4.1.1714.1.1.1.1.10.0':1},
+    ...             BASE_OIDS['sun3510'])
+    {'1.3.6.1.4.1.42.2.180.3510.1.1.1.1.10.0': 1}
+    '''
+    for name in ('infortrend', 'infortrend1', 'sun3510', 'sun3511'):
+        if BASE_OIDS[name] + '1.1.1.10.0' in tree:
+            walkBase = BASE_OIDS[name]
+            break
+    else:
+        return tree
+
+    rebased = {}
+
+    for oid, value in tree.items():
+        if oid.startswith(walkBase):
+            oid = base_oid + oid[len(walkBase):]
+        rebased[oid] = value
+
+    return rebased
+
+def synthetic_tree(base_oid=BASE_OIDS['infortrend1'], drives=12,
+                   logical_drives=1, devices=16, failed_drives=0,
+                   absent_drives=0, device_faults=0, serial_number=8001234):
+    '''
+    Generate the OID tree of an array with the given number of drives,
+    logical drives and luDev rows. The first failed_drives drives are
+    failed, the following absent_drives are absent and the first
+    device_faults luDev rows that have a status report a malfunction.
+
+    >>> tree = synthetic_tree(drives=4, failed_drives=1, devices=3)
+    >>> tree['1.3.6.1.4.1.1714.1.1.6.1.11.1'], tree['1.3.6.1.4.1.1714.1.1.6.1.11.2']
+    (255, 1)
+    >>> tree['1.3.6.1.4.1.1714.1.1.9.1.8.2']
+    'Cooling Fan 1'
+    '''
+    base = base_oid
+    tree = {base + '1.1.1.4.0':3,
+            base + '1.1.1.5.0':86,
+            base + '1.1.1.10.0':serial_number,
+            base + '1.1.1.13.0':'DS S16F-R2840',
+            base + '1.1.1.14.0':'Infortrend',
+            }
+
+    for ld in range(1, logical_drives + 1):
+        tree[base + '1.2.1.6.%d' % ld] = 0
+        tree[base + '1.2.1.8.%d' % ld] = drives // logical_drives
+        tree[base + '1.2.1.10.%d' % ld] = 0
+        tree[base + '1.2.1.11.%d' % ld] = 0
+
+    for drive in range(1, drives + 1):
+        if drive <= failed_drives:
+            status = 255
+        elif drive <= failed_drives + absent_drives:
+            status = 63
+        else:
+            status = 1
+
+        tree[base + '1.6.1.11.%d' % drive] = status
+        tree[base + '1.6.1.15.%d' % drive] = 'HUS726T4TALA6L4 %04d' % drive
+        tree[base + '1.6.1.17.%d' % drive] = 'V6G%05d' % drive
+
+    if failed_drives or absent_drives:
+        for ld in range(1, logical_drives + 1):
+            tree[base + '1.2.1.6.%d' % ld] = 3
+        tree[base + '1.2.1.11.1'] = failed_drives + absent_drives
+
+    faults = 0
+    for row in range(1, devices + 1):
+        cycle, position = divmod(row - 1, len(SYNTHETIC_DEVICES))
+        deviceType, description, value, unit = SYNTHETIC_DEVICES[position]
+
+        status = 0
+        if faults < device_faults and deviceType != 12:
+            status = 1
+            faults += 1
+
+        tree[base + '1.9.1.6.%d' % row] = deviceType
+        tree[base + '1.9.1.8.%d' % row] = description % (cycle + 1)
+        tree[base + '1.9.1.9.%d' % row] = value
+        tree[base + '1.9.1.10.%d' % row] = unit
+        tree[base + '1.9.1.13.%d' % row] = status
+
+    return tree
+
+def format_walk(tree):
+    '''
+    Return tree formatted like the output of snmpwalk -On, which
+    parse_walk reads back.
+
+    >>> print format_walk({'1.3.6.1.4.1.1714.1.1.1.10.0':42})
+    .1.3.6.1.4.1.1714.1.1.1.10.0 = INTEGER: 42
+    '''
+    names = dict([(tag, style) for style, tag in WALK_INTEGER_TYPES.items()])
+    lines = []
+
+    for oid in sorted(tree, key=_oid_tuple):
+        value = tree[oid]
+
+        if isinstance(value, tuple):
+            lines.append('.%s = %s: %s' % (oid, names[value[0]], value[1]))
+        elif isinstance(value, (int, long)):
+            lines.append('.%s = INTEGER: %s' % (oid, value))
+        else:
+            lines.append('.%s = STRING: "%s"' % (oid, value))
+
+    return '\n'.join(lines)
+
+
+class InfortrendSimulator(object):
+    '''
+    A UDP SNMPv1/v2c agent answering GET, GETNEXT and GETBULK requests
+    from a dictionary of OID to value.
+
+    tree: a dictionary of OID to value, see parse_walk
+    host: a string, address to listen on
+    port: an integer, port to listen on, 0 picks a free one
+    community: a string, requests with any other community are ignored
+    latency: a float, seconds to wait before answering each request
+    max_size: an integer, largest response in bytes, GETBULK responses are
+    cut short to fit and other requests fail with tooBig
+
+    >>> simulator = InfortrendSimulator(synthetic_tree(drives=4,
+    ...                                                failed_drives=1))
+    >>> simulator.start()
+    >>> from check_infortrend import CheckInfortrend
+    >>> check = CheckInfortrend(None, agent='127.0.0.1:%d' % simulator.port)
+    >>> check.run_checks()
+    >>> check.parse_results()[0]
+    2
+    >>> check.base_oid
+    '1.3.6.1.4.1.1714.1.'
+    >>> [component['text'] for component in check.result().components
+    ...  if component['severity'] == 'critical']
+    ['Drive 1: Failed Drive']
+    >>> simulator.stop()
+    '''
+
+    def __init__(self, tree, host='127.0.0.1', port=0, community='public',
+                 latency=0.0, max_size=1472):
+
+        self.community = community
+        self.latency = latency
+        self.max_size = max_size
+
+        self.load(tree)
+
+        # Number of requests answered, for benchmarks
+        self.requests = 0
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.thread = None
+        self.running = False
+
+    def load(self, tree):
+        '''
+        Replace the OID tree being served.
+        '''
+        oids = sorted(tree, key=_oid_tuple)
+        self.tree = tree
+        self.oids = oids
+        self.keys = [_oid_tuple(oid) for oid in oids]
+
+        return None
+
+    def _next(self, oid):
+        '''
+        For internal use, returns the first OID after oid, or None at the
+        end of the tree.
+        '''
+        position = bisect.bisect_right(self.keys, _oid_tuple(oid))
+
+        if position < len(self.oids):
+            return self.oids[position]
+
+        return None
+
+    def _encode_value(self, value):
+        '''
+        For internal use, BER encodes a value of the tree.
+        '''
+        if isinstance(value, tuple):
+            tag, number = value
+            return _ber_tlv(tag, _ber_integer(number)[2:])
+        elif isinstance(value, (int, long)):
+            return _ber_integer(value)
+
+        return _ber_tlv(ASN1_OCTET_STRING, value)
+
+    def _varbind(self, oid, value):
+        '''
+        For internal use, BER encodes one varbind.
+        '''
+        return _ber_tlv(ASN1_SEQUENCE, _ber_oid(oid) + value)
+
+    def _response(self, version, community, request_id, varbinds,
+                  error_status=0, error_index=0):
+        '''
+        For internal use, builds a response message.
+        '''
+        pdu = _ber_tlv(PDU_RESPONSE, _ber_integer(request_id) +
+                                     _ber_integer(error_status) +
+                                     _ber_integer(error_index) +
+                                     _ber_tlv(ASN1_SEQUENCE,
+                                              ''.join(varbinds)))
+
+        return _ber_tlv(ASN1_SEQUENCE, _ber_integer(version) +
+                        _ber_tlv(ASN1_OCTET_STRING, community) + pdu)
+
+    def answer(self, message):
+        '''
+        Returns the response to the request message, or None if it should
+        be ignored.
+        '''
+        data = bytearray(message)
+
+        tag, start, end = _ber_read(data, 0)
+        tag, start, offset = _ber_read(data, start)
+        version = _ber_decode_integer(data[start:offset])
+        tag, start, offset = _ber_read(data, offset)
+        community = str(data[start:offset])
+
+        if community != self.community:
+            return None
+
+        pduType, start, end = _ber_read(data, offset)
+        fields = []
+        offset = start
+        for i in range(3):
+            tag, start, offset = _ber_read(data, offset)
+            fields.append(_ber_decode_integer(data[start:offset]))
+        requestId, field1, field2 = fields
+
+        tag, offset, end = _ber_read(data, offset)
+        oids = []
+        while offset < end:
+            tag, start, offset = _ber_read(data, offset)
+            tag, oidStart, oidEnd = _ber_read(data, start)
+            oids.append(_ber_decode_oid(data[oidStart:oidEnd]))
+
+        endOfMib = _ber_tlv(SNMP_ENDOFMIBVIEW, '')
+        varbinds = []
+
+        if pduType == PDU_GET:
+            for position, oid in enumerate(oids):
+                if oid in self.tree:
+                    varbinds.append(self._varbind(
+                        oid, self._encode_value(self.tree[oid])))
+                elif version == 0:
+                    return self._response(version, community, requestId,
+                                          [self._varbind(oid, '\x05\x00')
+                                           for oid in oids],
+                                          SNMP_ERROR_NOSUCHNAME, position + 1)
+                else:
+                    varbinds.append(self._varbind(
+                        oid, _ber_tlv(SNMP_NOSUCHOBJECT, '')))
+
+        elif pduType == PDU_GETNEXT:
+            for position, oid in enumerate(oids):
+                nextOid = self._next(oid)
+
+                if nextOid is not None:
+                    varbinds.append(self._varbind(
+                        nextOid, self._encode_value(self.tree[nextOid])))
+                elif version == 0:
+                    return self._response(version, community, requestId,
+                                          [self._varbind(oid, '\x05\x00')
+                                           for oid in oids],
+                                          SNMP_ERROR_NOSUCHNAME, position + 1)
+                else:
+                    varbinds.append(self._varbind(oid, endOfMib))
+
+        elif pduType == PDU_GETBULK:
+            nonRepeaters = min(max(field1, 0), len(oids))
+            current = list(oids)
+
+            for position in range(nonRepeaters):
+                nextOid = self._next(oids[position])
+                if nextOid is None:
+                    varbinds.append(self._varbind(oids[position], endOfMib))
+                else:
+                    varbinds.append(self._varbind(
+                        nextOid, self._encode_value(self.tree[nextOid])))
+
+            size = sum([len(varbind) for varbind in varbinds])
+
+            for repetition in range(max(field2, 0)):
+                if nonRepeaters == len(oids):
+                    break
+
+                row = []
+                for position in range(nonRepeaters, len(oids)):
+                    nextOid = self._next(current[position])
+                    if nextOid is None:
+                        row.append(self._varbind(current[position],
+                                                 endOfMib))
+                    else:
+                        row.append(self._varbind(
+                            nextOid, self._encode_value(self.tree[nextOid])))
+                        current[position] = nextOid
+
+                rowSize = sum([len(varbind) for varbind in row])
+
+                # Leave room for the message header
+                if repetition and size + rowSize > self.max_size - 64:
+                    break
+
+                varbinds.extend(row)
+                size += rowSize
+        else:
+            return None
+
+        response = self._response(version, community, requestId, varbinds)
+
+        if len(response) > self.max_size:
+            return self._response(version, community, requestId,
+                                  [self._varbind(oid, '\x05\x00')
+                                   for oid in oids], SNMP_ERROR_TOOBIG, 0)
+
+        return response
+
+    def serve(self):
+        '''
+        Answer requests until stop is called.
+        '''
+        self.sock.settimeout(0.2)
+
+        while self.running:
+            try:
+                message, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+
+            try:
+                response = self.answer(message)
+            except SnmpError:
+                continue
+
+            if response is None:
+                continue
+
+            self.requests += 1
+
+            if self.latency:
+                time.sleep(self.latency)
+
+            self.sock.sendto(response, address)
+
+        return None
+
+    def start(self):
+        '''
+        Start answering requests in a background thread.
+        '''
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return None
+
+    def stop(self):
+        '''
+        Stop answering requests and close the socket.
+        '''
+        self.running = False
+
+        if self.thread:
+            self.thread.join()
+
+        self.sock.close()
+
+        return None
+
+if __name__ == '__main__':
+    import optparse
+
+    parser = optparse.OptionParser(description='''Local SNMP agent
+    simulating an Infortrend based RAID for check_infortrend.''',
+    prog='infortrend_simulator')
+    parser.add_option('--absent-drives', dest='absent_drives', default=0,
+                      type='int', help=('Number of absent drives '
+                      '(Default: %default)'))
+    parser.add_option('-b', '--base-oid', action='store', type='choice',
+                      dest='base_oid', choices=sorted(BASE_OIDS),
+                      default='infortrend1',
+                      help=('Vendor tree to serve: %s (Default: %%default)'
+                      % (', '.join(sorted(BASE_OIDS)))))
+    parser.add_option('-c', '--community', action='store', type='string',
+                      dest='community', default='public',
+                      help='SNMP Community String (Default: %default)')
+    parser.add_option('--device-faults', dest='device_faults', default=0,
+                      type='int', help=('Number of luDev rows reporting a '
+                      'malfunction (Default: %default)'))
+    parser.add_option('--devices', dest='devices', default=16, type='int',
+                      help='Number of luDev rows (Default: %default)')
+    parser.add_option('--drives', dest='drives', default=12, type='int',
+                      help='Number of drives (Default: %default)')
+    parser.add_option('--dump', action='store_true', dest='dump',
+                      default=False, help=('Print the tree as a walk file '
+                      'and exit'))
+    parser.add_option('--failed-drives', dest='failed_drives', default=0,
+                      type='int', help='Number of failed drives '
+                      '(Default: %default)')
+    parser.add_option('-H', '--host', action='store', type='string',
+                      dest='host', default='127.0.0.1',
+                      help='Address to listen on (Default: %default)')
+    parser.add_option('--latency', dest='latency', default=0.0,
+                      type='float', help=('Seconds to wait before each '
+                      'answer (Default: %default)'))
+    parser.add_option('--logical-drives', dest='logical_drives', default=1,
+                      type='int', help=('Number of logical drives '
+                      '(Default: %default)'))
+    parser.add_option('-p', '--port', dest='port', default=16100, type='int',
+                      help='UDP port to listen on (Default: %default)')
+    parser.add_option('-w', '--walk', action='store', type='string',
+                      dest='walk', default=None,
+                      help=('Serve a walk recorded with snmpwalk -On '
+                      'instead of a synthetic array'))
+
+    (options, args) = parser.parse_args()
+
+    base_oid = BASE_OIDS[options.base_oid]
+
+    if options.walk:
+        TREE = rebase_tree(parse_walk(open(options.walk)), base_oid)
+    else:
+        TREE = synthetic_tree(base_oid, options.drives,
+                              options.logical_drives, options.devices,
+                              options.failed_drives, options.absent_drives,
+                              options.device_faults)
+
+    if options.dump:
+        print format_walk(TREE)
+        sys.exit(0)
+
+    SIMULATOR = InfortrendSimulator(TREE, options.host, options.port,
+                                    options.community, options.latency)
+
+    print 'Serving %d OIDs on %s:%d' % (len(TREE), options.host,
+                                        SIMULATOR.port)
+
+    SIMULATOR.running = True
+
+    try:
+        SIMULATOR.serve()
+    except KeyboardInterrupt:
+        pass